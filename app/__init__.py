@@ -3,10 +3,25 @@
 # --------------------------------------------------------------------
 
 from .models import User
+from .commentlog import CommentLog
+from .commentdb import CommentDatabase, ShowComments
+from .broadcast import Broadcaster
+from .schedule import ScheduleIndex, copy_schedule, diff_schedule, apply_schedule_diff
+from .state import LocalStateBackend, SqliteStateBackend
+from .ratelimit import TokenBucketTable, DuplicateFilter
+from .ingest import IngestQueue
+from .metrics import MetricsRegistry, TimedLock, LogCounter, BYTE_BUCKETS
+from .durable import read_json, write_json, previous_path
+from .archive import write_archive, read_archive, list_episodes, prune_archives
+from .accounts import AccountStore, hash_passwords
+from .snapshot import SnapshotPublisher
+from .encoding import EncodedBody
+from .logqueue import configure_logging, DroppingQueueHandler, EventRateFilter, JSONFormatter
 
 # basic imports
 import json
 import requests
+import concurrent.futures
 import atexit
 import logging
 import os
@@ -14,12 +29,15 @@ import sys
 import glob
 import re
 import time
+import datetime
 import pathvalidate
+from collections import namedtuple
 from threading import Lock
 
 from flask import Flask
 from flask_cors import CORS
 from flask_login import LoginManager
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 flaskapp = Flask(__name__)
 CORS(flaskapp)
@@ -27,6 +45,10 @@ CORS(flaskapp)
 # load config data from config.py
 flaskapp.config.from_object("config")
 
+# then override any of it from the file named by the COMMENT_SERVER_SETTINGS environment variable, if set
+# (used by the benchmarks to run against scratch data)
+flaskapp.config.from_envvar("COMMENT_SERVER_SETTINGS", silent=True)
+
 loginmanager = LoginManager()
 loginmanager.init_app(flaskapp)
 loginmanager.login_view = "login"
@@ -40,64 +62,281 @@ from apscheduler.schedulers.background import BackgroundScheduler
 # current path to "comment_server"
 BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
 
+# data locations below are set from the config by set_paths, and again by create_app with the final config
+
+# directory holding the schedule & comments
+DATA_DIR = None
+
 # file with information on shows & comment preferences
-SCHEDULEFILE = "%s/json/schedule.json" % BASE_DIR
+SCHEDULEFILE = None
+
+# file with comment preferences of the rooms on COMMENT_MOUNTPOINTS
+ROOMSETTINGSFILE = None
 
 # directory in which to create json comment objects
-COMMENTSDIR = "%s/json/comments" % BASE_DIR
+COMMENTSDIR = None
+
+# directory holding archived comments, in a directory per episode
+ARCHIVEDIR = None
+
+def set_paths():
+    global DATA_DIR, SCHEDULEFILE, ROOMSETTINGSFILE, COMMENTSDIR, ARCHIVEDIR
+    DATA_DIR = flaskapp.config['DATA_DIRECTORY'] or "%s/json" % BASE_DIR
+    SCHEDULEFILE = "%s/schedule.json" % DATA_DIR
+    ROOMSETTINGSFILE = "%s/room_settings.json" % DATA_DIR
+    COMMENTSDIR = "%s/comments" % DATA_DIR
+    ARCHIVEDIR = flaskapp.config['ARCHIVE_DIRECTORY'] or "%s/archive" % DATA_DIR
+
+set_paths()
+
+# metrics
+
+# served on /metrics if METRICS_ENABLED - read when the module is imported, so it can't be changed through create_app - otherwise every metric below is a no-op
+metrics = MetricsRegistry(flaskapp.config['METRICS_ENABLED'])
+
+requestseconds = metrics.histogram("comment_server_request_duration_seconds", "Time spent handling requests", ("route", "method", "status"))
+icecastseconds = metrics.histogram("comment_server_icecast_fetch_seconds", "Time spent fetching Icecast status", ("result",))
+schedulerefreshseconds = metrics.histogram("comment_server_schedule_refresh_seconds", "Time spent refreshing the schedule", ("result",))
+commentiobytes = metrics.histogram("comment_server_comment_io_bytes", "Bytes of comments read from & written to storage", ("operation",), BYTE_BUCKETS)
+commentioseconds = metrics.histogram("comment_server_comment_io_seconds", "Time spent reading comments from & writing them to storage", ("operation",))
+commentlockwaitseconds = metrics.histogram("comment_server_comment_lock_wait_seconds", "Time spent waiting to read or write a comment store", ("storage",))
+loggedmessages = metrics.counter("comment_server_log_messages_total", "Warnings & errors logged", ("level",))
 
 # global variables
 
 tasksched = BackgroundScheduler()
 
-schedobj = None
+# state shared with other worker processes, replaced by create_app() according to STATE_BACKEND
+statebackend = LocalStateBackend()
 
+# versions of the shared schedule & stream status this process last loaded or stored, and when it last checked
+syncedversions = {}
+lastsynctime = 0
+
+# index over the current schedule obj, replaced in whole whenever the schedule changes
+schedindex = None
+
+# (generation, {room name: comment setting}) for rooms on COMMENT_MOUNTPOINTS that an admin has set, replaced in whole
+# on every change - rooms not in here go by their show's setting on the schedule
+roomsettings = (0, {})
+
+# validators of the last source schedule applied, so refresh_schedule can skip it while it's unchanged:
+# {location, etag, lastmodified} for a URL, or {location, mtime, size} for a local file
+schedulesource = {}
+
+# SQLite comment database, if COMMENT_STORAGE is "sqlite"
+commentdb = None
+
+# guards commentlogs & broadcasters
 commentfilelock = Lock()
 
-streamstatus = {
-    'show_running'  : False,
-    'show_name'     : "",
-    'check_time'    : 0
-}
+# open comment stores (CommentLog, or ShowComments with SQLite storage), keyed by get_comment_key
+commentlogs = {}
+
+# event queues for /comments/stream subscribers, keyed by get_comment_key
+broadcasters = {}
+
+# per-client token buckets for comment submissions, if COMMENT_RATE is set
+commentratelimits = None
+
+# queue committing submitted comments in batches, if COMMENT_INGEST is "queue"
+ingestqueue = None
+
+# admin console accounts from ACCOUNTFILE, set up by create_app()
+accountstore = None
+
+# per-username & per-address token buckets for failed logins, if LOGIN_FAILURE_RATE is set
+loginfailurelimits = None
 
-# startup tasks
-def startup():
+# recently posted comments, for turning away duplicates, keyed by get_comment_key
+# guarded by commentfilelock
+duplicatefilters = {}
 
-    # configure logging
-    logging.basicConfig(filename=flaskapp.config['LOGFILE'],
-        format='%(asctime)s %(levelname)-8s %(message)s',
-        level=logging.INFO,
-        datefmt='%Y-%m-%d %H:%M:%S')
+# immutable snapshot of the main mountpoint's status, replaced in whole by the background poller,
+# so request handlers can read it without locking
+# check_time is the time of the last successful Icecast check, and generation is bumped whenever
+# show_running or show_name changes
+StreamStatus = namedtuple("StreamStatus", ["show_running", "show_name", "check_time", "generation"])
+
+streamstatus = StreamStatus(False, "", 0, 0)
+
+# status snapshots of the other mountpoints with comment rooms (COMMENT_MOUNTPOINTS), keyed by mountpoint,
+# each replaced in whole like streamstatus
+mountstatuses = {}
+
+# static snapshots of the comment rooms, written to SNAPSHOT_DIRECTORY, set up by create_app() if it's set
+snapshotpublisher = None
+
+# thread writing queued log records out to LOGFILE, set up by create_app() if LOG_QUEUE_SIZE is set
+loglistener = None
+
+# whether create_app has run, and whether this worker has finished its first schedule load after start_scheduler
+initialized = False
+ready = False
+
+# Icecast's "single dash" bug leaves values out, as in "key":-, - fixed up only if its status fails to parse
+ICECAST_DASH_PATTERN = re.compile("([^\\\\])([\"\']): *- *,([\"\'])")
+
+# pooled HTTP connections to Icecast
+icecastsession = requests.Session()
+
+# set up the comment server & return its Flask app - importing the app package has no side effects
+# config is an optional dict of settings applied on top of config.py & COMMENT_SERVER_SETTINGS
+# opens storage & loads the schedule saved on disk, but doesn't touch the network or start any threads -
+# call start_scheduler afterwards to serve live stream status & schedule updates
+# only the first call does anything, later ones return the same app
+def create_app(config=None):
+    global initialized
+    if initialized:
+        return flaskapp
+    initialized = True
+
+    if config is not None:
+        flaskapp.config.update(config)
+        set_paths()
+
+    # configure logging, written out by a background thread unless LOG_QUEUE_SIZE is 0
+    global loglistener
+    loglistener = configure_logging(flaskapp.config['LOGFILE'], flaskapp.config['LOG_FORMAT'] == "json", flaskapp.config['LOG_QUEUE_SIZE'],
+        flaskapp.config['LOG_EVENT_LIMIT'], flaskapp.config['LOG_EVENT_INTERVAL'])
 
     # load basic schedule
     logging.info("started server")
 
-    global schedobj
-    schedobj = open_schedule()
+    global statebackend
+    if flaskapp.config['STATE_BACKEND'] == "sqlite":
+        statebackend = SqliteStateBackend(flaskapp.config['STATE_DATABASE'] or "%s/state.db" % DATA_DIR)
+
+    global commentdb
+    if flaskapp.config['COMMENT_STORAGE'] == "sqlite":
+        commentdb = CommentDatabase(flaskapp.config['COMMENT_DATABASE'] or "%s/comments.db" % DATA_DIR)
+
+    for mount in flaskapp.config['COMMENT_MOUNTPOINTS']:
+        if mount != flaskapp.config['MAIN_MOUNTPOINT']:
+            mountstatuses[mount] = StreamStatus(False, "", 0, 0)
+
+    global accountstore
+    accountstore = AccountStore(flaskapp.config['ACCOUNTFILE'])
+
+    # take client addresses from X-Forwarded-For, as set by the reverse proxies in front of the app
+    if flaskapp.config['PROXY_COUNT'] > 0:
+        flaskapp.wsgi_app = ProxyFix(flaskapp.wsgi_app, x_for=flaskapp.config['PROXY_COUNT'])
+
+    global loginfailurelimits
+    if flaskapp.config['LOGIN_FAILURE_RATE'] > 0:
+        loginfailurelimits = TokenBucketTable(flaskapp.config['LOGIN_FAILURE_RATE'], flaskapp.config['LOGIN_FAILURE_BURST'], flaskapp.config['RATE_LIMIT_TABLE_SIZE'])
+
+    global snapshotpublisher
+    if flaskapp.config['SNAPSHOT_DIRECTORY']:
+        snapshotpublisher = SnapshotPublisher(flaskapp.config['SNAPSHOT_DIRECTORY'], flaskapp.config['SNAPSHOT_INTERVAL'], render_snapshots,
+            statebackend.lock("snapshots") if statebackend.shared else None, flaskapp.config['SNAPSHOT_DURABILITY'])
+
+    global commentratelimits
+    if flaskapp.config['COMMENT_RATE'] > 0:
+        commentratelimits = TokenBucketTable(flaskapp.config['COMMENT_RATE'], flaskapp.config['COMMENT_BURST'], flaskapp.config['RATE_LIMIT_TABLE_SIZE'])
+
+    global ingestqueue
+    if flaskapp.config['COMMENT_INGEST'] == "queue":
+        ingestqueue = IngestQueue(flaskapp.config['INGEST_BATCH_SIZE'], flaskapp.config['INGEST_BATCH_WAIT'])
+        ingestqueue.start()
+
+    if metrics.enabled:
+        logging.getLogger().addHandler(LogCounter(loggedmessages))
+        metrics.gauge("comment_server_comments", "Comments held by each open comment store", ("show",), get_comment_counts)
+        if ingestqueue is not None:
+            metrics.gauge("comment_server_ingest_queue_depth", "Comments waiting to be committed", (),
+                lambda: {(): ingestqueue.get_metrics()['depth']})
+            metrics.gauge("comment_server_ingest_batches_total", "Comment batches committed", (),
+                lambda: {(): ingestqueue.get_metrics()['batches']}, kind="counter")
+            metrics.gauge("comment_server_ingest_committed_total", "Comments committed through the ingest queue", (),
+                lambda: {(): ingestqueue.get_metrics()['committed']}, kind="counter")
+
+    # serve the schedule saved on disk until the first refresh, so starting up never waits on the network
+    publish_schedule(open_schedule(), share=False)
+    publish_room_settings(read_json(ROOMSETTINGSFILE, lambda settings: type(settings) == type({})) or {}, share=False)
+
+    # pick up schedule & stream status already shared by other workers
+    sync_shared_state(force=True)
 
-    # load schedule from provided JSON object
-    refresh_schedule()
+    # stop scheduled pulls on program exit
+    atexit.register(shutdown)
+
+    return flaskapp
+
+# start the background jobs - stream status polling, schedule pulls, comment clearing & compaction
+# the first schedule load runs as one of them, so the server can take requests while it's fetched,
+# and /healthz reports ready once it's done
+def start_scheduler():
+    if tasksched.running:
+        return
+
+    # load schedule from provided JSON object, right away
+    tasksched.add_job(func=load_schedule, trigger="date", run_date=datetime.datetime.now())
+
+    # the remaining jobs are scheduled in every worker, but only run in the elected one
+    # poll Icecast in the background, starting right away
+    tasksched.add_job(func=leader_job(update_stream_status), trigger="interval", seconds=flaskapp.config['STREAM_STATUS_INTERVAL'],
+        next_run_time=datetime.datetime.now())
 
     # schedule hourly pulls & daily clear
-    tasksched.add_job(func=refresh_schedule, trigger="cron", **flaskapp.config['REFRESH_SCHEDULE_CRON'])
+    tasksched.add_job(func=leader_job(refresh_schedule), trigger="cron", **flaskapp.config['REFRESH_SCHEDULE_CRON'])
 
     # executes at 2 AM
-    tasksched.add_job(func=clear_comments, trigger="cron", **flaskapp.config['CLEAR_COMMENTS_CRON'])
+    tasksched.add_job(func=leader_job(clear_comments), trigger="cron", **flaskapp.config['CLEAR_COMMENTS_CRON'])
+
+    # periodic fsync & compaction of comment logs
+    tasksched.add_job(func=compact_comments, trigger="cron", **flaskapp.config['COMPACT_COMMENTS_CRON'])
+
+    # periodic report on batched comment ingest
+    if ingestqueue is not None and flaskapp.config['INGEST_METRICS_INTERVAL'] > 0:
+        tasksched.add_job(func=log_ingest_metrics, trigger="interval", seconds=flaskapp.config['INGEST_METRICS_INTERVAL'])
+
+    # timeslots change on the hour, which can change whether comments are enabled without anything else happening
+    if snapshotpublisher is not None:
+        tasksched.add_job(func=request_snapshot, trigger="cron", minute=0)
+        snapshotpublisher.start()
 
     tasksched.start()
+
+# first schedule load - the elected worker pulls the schedule source, the others take the schedule it shares
+def load_schedule():
+    global ready
+    try:
+        if statebackend.elect_leader():
+            refresh_schedule()
+        else:
+            sync_shared_state(force=True)
+    finally:
+        # a failed pull still leaves the saved schedule being served, so don't hold readiness back on it
+        ready = True
     
 # shutdown tasks
 def shutdown():
     # stop scheduled tasks
-    tasksched.shutdown()
-    
-# run when __name__=="__main__"
-def main():
-    # run startup tasks
-    startup()
-   
-    # stop scheduled pulls on program exit
-    atexit.register(shutdown)
+    if tasksched.running:
+        tasksched.shutdown()
+
+    # commit any queued comments
+    if ingestqueue is not None:
+        ingestqueue.stop()
+
+    # bring snapshots up to date with the last comments
+    if snapshotpublisher is not None:
+        snapshotpublisher.stop()
+
+    # flush & close comment logs
+    with commentfilelock:
+        for commentlog in commentlogs.values():
+            commentlog.close()
+
+    # hand off scheduled tasks to another worker
+    statebackend.close()
+
+    # write out any log records still queued
+    global loglistener
+    if loglistener is not None:
+        loglistener.stop()
+        loglistener = None
 
 # LoginManager load user function
 @loginmanager.user_loader
@@ -111,176 +350,617 @@ def create_empty_sched():
     return [{}, {}, {}, {}, {}, {}, {}]
 
 # opens schedule from json file, or creates it if it doesn't exist
+# a damaged schedule file is recovered from its previous generation where possible
 # obj is [{time: {name, comments enabled}}]
 def open_schedule():
-    try:
-        if os.path.exists(SCHEDULEFILE):
-            with open(SCHEDULEFILE) as schedfile:
-                return json.load(schedfile)
-        else:
-            return create_empty_sched()
-
-    # if json is invalid
-    except ValueError:
+    schedobj = read_json(SCHEDULEFILE, lambda schedobj: type(schedobj) == type([]) and len(schedobj) == 7)
+    if schedobj is None:
         return create_empty_sched()
-
-    # something else?
-    except Exception as err:
-        raise err
-
-# search schedule for show, return their comment setting, or default comment value if show not found
+    return schedobj
+
+# saves a schedule obj to the schedule file, keeping the previous one to recover from - see durable.write_file
+def write_schedule(schedobj):
+    write_json(SCHEDULEFILE, schedobj, flaskapp.config['WRITE_DURABILITY'], keepprevious=True)
+
+# wraps a scheduled task so it only runs in the worker elected by the state backend
+def leader_job(func):
+    def job():
+        if statebackend.elect_leader():
+            func()
+    job.__name__ = func.__name__
+    return job
+
+# load schedule & stream status changes made by other worker processes
+# only checks the state backend every STATE_SYNC_INTERVAL seconds, unless forced
+def sync_shared_state(force=False):
+    global lastsynctime
+    if not statebackend.shared or (not force and time.time() - lastsynctime < flaskapp.config['STATE_SYNC_INTERVAL']):
+        return
+    lastsynctime = time.time()
+    versions = statebackend.get_versions()
+    if versions.get("schedule", 0) != syncedversions.get("schedule", 0):
+        syncedversions['schedule'], newschedobj = statebackend.get("schedule")
+        publish_schedule(newschedobj, share=False)
+    if versions.get("roomsettings", 0) != syncedversions.get("roomsettings", 0):
+        syncedversions['roomsettings'], newsettings = statebackend.get("roomsettings")
+        publish_room_settings(newsettings, share=False)
+    # main mountpoint's status is stored under "streamstatus", others under "streamstatus@<<MOUNTPOINT>>"
+    for key, version in versions.items():
+        mount = key.partition("@")[2] or None
+        if key.partition("@")[0] == "streamstatus" and version != syncedversions.get(key, 0) and (mount is None or mount in mountstatuses):
+            syncedversions[key], newstatus = statebackend.get(key)
+            publish_stream_status(*newstatus, share=False, mount=mount)
+
+# build an index over a new schedule obj and swap it in, storing it in the state backend unless share is False
+def publish_schedule(newschedobj, share=True):
+    global schedindex
+    schedindex = ScheduleIndex(newschedobj, schedindex.generation + 1 if schedindex else 0)
+    if share and statebackend.shared:
+        syncedversions['schedule'] = statebackend.set("schedule", newschedobj)
+    request_snapshot()
+
+# swap in new room comment settings, storing them in the state backend unless share is False
+def publish_room_settings(newsettings, share=True):
+    global roomsettings
+    roomsettings = (roomsettings[0] + 1, newsettings)
+    if share and statebackend.shared:
+        syncedversions['roomsettings'] = statebackend.set("roomsettings", newsettings)
+    request_snapshot()
+
+# the current schedule obj, which must not be modified in place
+def get_schedule():
+    return schedindex.schedobj
+
+# look up show, return their comment setting, or default comment value if show not found
 def get_show_comment_setting(showname):
-    for day in schedobj:
-        for hour in day.keys():
-            if day[hour]['show'] == showname:
-                return day[hour]['comments']
-    return flaskapp.config['DEFAULT_COMMENT_SETTING']
+    return schedindex.settings.get(showname, flaskapp.config['DEFAULT_COMMENT_SETTING'])
+
+# comment setting of a show's room on the main mountpoint, or the given one - rooms on other mountpoints go by
+# the setting an admin gave the room, falling back on the show's own
+def get_room_comment_setting(showname, mount=None):
+    if mount is None:
+        return get_show_comment_setting(showname)
+    return roomsettings[1].get(get_room_name(showname, mount), get_show_comment_setting(showname))
+
+# set the comment setting of a show's room on the given mountpoint, which needn't be on the schedule
+def set_room_comment_setting(showname, mount, comment):
+    with statebackend.lock("roomsettings"):
+        # make sure this is applied on top of the latest settings from other workers
+        sync_shared_state(force=True)
+        newsettings = dict(roomsettings[1])
+        newsettings[get_room_name(showname, mount)] = comment
+        write_json(ROOMSETTINGSFILE, newsettings, flaskapp.config['WRITE_DURABILITY'], keepprevious=True)
+        publish_room_settings(newsettings)
 
 # set comment enabled setting for a given showname
 def set_show_comment_setting(showname, comment):
-    schedobjchanged = False
-    for day in schedobj:
-        for hour in day.keys():
-            if day[hour]['show'] == showname:
-                if day[hour]['comments'] != comment:
-                    schedobjchanged = True
-                day[hour]['comments'] = comment
-    if schedobjchanged:
-        with open(SCHEDULEFILE, mode="w") as schedfile:
-            json.dump(schedobj, schedfile)
+    with statebackend.lock("schedule"):
+        # make sure this is applied on top of the latest schedule from other workers
+        sync_shared_state(force=True)
+        slots = schedindex.slots.get(showname, [])
+        if any(schedindex.get_slot(day, hour)['comments'] != comment for day, hour in slots):
+            newschedobj = copy_schedule(schedindex.schedobj)
+            for day, hour in slots:
+                newschedobj[day][str(hour)]['comments'] = comment
+            write_schedule(newschedobj)
+            publish_schedule(newschedobj)
 
 # properly sanitized icecast stream status (None on error)
 def get_stream_status():
+    start = time.perf_counter()
     try:
-        statusresp = requests.get(flaskapp.config['ICECAST_STATUS_URL'])
+        statusresp = icecastsession.get(flaskapp.config['ICECAST_STATUS_URL'], timeout=flaskapp.config['ICECAST_TIMEOUT'])
         if statusresp.status_code == 200:
-            # fixing the icecast single dash bug
-            statustext = re.sub("([^\\\\])([\"\']): *- *,([\"\'])", "\\1\\2:\"-\",\\3", statusresp.text)
-            return json.loads(statustext)
+            try:
+                status = json.loads(statusresp.text)
+            except ValueError:
+                # fixing the icecast single dash bug
+                status = json.loads(ICECAST_DASH_PATTERN.sub("\\1\\2:\"-\",\\3", statusresp.text))
+            icecastseconds.observe(time.perf_counter() - start, "ok")
+            return status
         else:
+            icecastseconds.observe(time.perf_counter() - start, "error")
             logging.error("Error accessing Icecast: HTTP Error %d" % statusresp.status_code)
             return None
     except Exception as err:
+        icecastseconds.observe(time.perf_counter() - start, "error")
         _, _, exc_tb = sys.exc_info()
         logging.error("Error getting status from Icecast: %s: %s at line %d" % (err.__class__.__name__, str(err), exc_tb.tb_lineno))
         return None
 
 
-# check if a show is currently on air on the configured main mountpoint
-# refreshes check every 5 seconds
-def check_show_running():
-    global streamstatus
-
-    if time.time() - streamstatus['check_time'] >= 5.0:
-        update_stream_status()
-
-    return streamstatus['show_running']
-
-def get_current_showname():
+# status snapshot of a mountpoint with a comment room, or None if it has none
+# mount is None for the main mountpoint, as it is throughout
+def get_mount_status(mount=None):
+    if mount is None:
+        return streamstatus
+    return mountstatuses.get(mount)
+
+# check if a show is currently on air on the configured main mountpoint, or the given one
+# status is refreshed in the background every STREAM_STATUS_INTERVAL seconds
+def check_show_running(mount=None):
+    return get_mount_status(mount).show_running
+
+def get_current_showname(mount=None):
+    return get_mount_status(mount).show_name
+
+# name a show's comment room is stored under - the show's name on the main mountpoint, "<<SHOW>>@<<MOUNTPOINT>>" on others
+def get_room_name(showname, mount=None):
+    return showname if mount is None else "%s@%s" % (showname, mount)
+
+# get comment log filename for the given show, or the current show if none is given
+def get_comment_file(showname=None):
+    if showname is None:
+        showname = get_current_showname()
+    return "%s/%s.log" % (COMMENTSDIR, pathvalidate.sanitize_filename(showname))
+
+# key for the given show's comment store in commentlogs & broadcasters
+# with log storage, shows whose names sanitize to the same filename share a log, so the key is the log's path
+def get_comment_key(showname):
+    if commentdb is not None:
+        return showname
+    return get_comment_file(showname)
+
+# comment episode a datetime falls in, as a YYYY-MM-DD string - episodes start at EPISODE_START_HOUR each day
+def get_episode(when):
+    return (when - datetime.timedelta(hours=flaskapp.config['EPISODE_START_HOUR'])).strftime("%Y-%m-%d")
+
+def get_current_episode():
+    return get_episode(datetime.datetime.now())
+
+# get comment store for the given show, or the current show if none is given, on the main mountpoint or the given one
+# stores are created the first time they're used and kept open afterwards
+def get_comment_log(showname=None, mount=None):
+    if showname is None:
+        showname = get_current_showname(mount)
+    room = get_room_name(showname, mount)
+    return get_comment_store(get_comment_key(room), room)
+
+# get comment store with the given key in commentlogs, for the given show, opening it if needed
+def get_comment_store(commentkey, showname):
+    commentlog = commentlogs.get(commentkey)
+    if commentlog is None:
+        with commentfilelock:
+            if commentkey not in commentlogs:
+                if commentkey not in broadcasters:
+                    broadcasters[commentkey] = Broadcaster(flaskapp.config['STREAM_BACKLOG'])
+                    # every change to the room's comments brings its snapshot up to date
+                    if snapshotpublisher is not None:
+                        broadcasters[commentkey].add_callback(snapshotpublisher.request)
+                broadcaster = broadcasters[commentkey]
+                if commentdb is not None:
+                    commentlogs[commentkey] = ShowComments(commentdb, showname, flaskapp.config['MAX_COMMENTS'], get_current_episode,
+                        listener=broadcaster.publish, observer=observe_comment_io if metrics.enabled else None,
+                        lockobserver=observe_comment_lock_wait if metrics.enabled else None,
+                        compressminsize=flaskapp.config['COMPRESS_MIN_SIZE'])
+                else:
+                    commentlogs[commentkey] = open_comment_log(commentkey, broadcaster)
+            commentlog = commentlogs[commentkey]
+    return commentlog
+
+# open a comment log file, replaying it from disk
+def open_comment_log(commentfile, broadcaster):
+    # with a shared state backend, other workers append to the same log, so it's locked across processes
+    lock = statebackend.lock("comments/%s" % os.path.basename(commentfile))
+    readlock = statebackend.lock("comments/%s" % os.path.basename(commentfile), shared=True)
+    commentlog = CommentLog(commentfile, flaskapp.config['MAX_COMMENTS'],
+        fsync=flaskapp.config['COMMENT_LOG_FSYNC'],
+        fsyncinterval=flaskapp.config['COMMENT_LOG_FSYNC_INTERVAL'],
+        durability=flaskapp.config['WRITE_DURABILITY'],
+        lock=TimedLock(lock, commentlockwaitseconds, "log") if metrics.enabled else lock,
+        readlock=TimedLock(readlock, commentlockwaitseconds, "log") if metrics.enabled else readlock,
+        shared=statebackend.shared,
+        listener=broadcaster.publish,
+        observer=observe_comment_io if metrics.enabled else None,
+        compressminsize=flaskapp.config['COMPRESS_MIN_SIZE'],
+        episodefunc=get_current_episode)
+
+    # carry over comments from a JSON comment file written by an older version of the server
+    legacyfile = "%s.json" % commentfile[:-len(".log")]
+    if not os.path.exists(commentfile) and os.path.exists(legacyfile):
+        comments = read_json(legacyfile)
+        if comments is not None:
+            commentlog.import_comments(comments)
+            os.remove(legacyfile)
+        else:
+            # leave it for an admin to look at, rather than failing every request for this show
+            logging.error("Error importing comments: %s is not valid JSON" % legacyfile)
+
+    return commentlog
+
+def observe_comment_io(operation, nbytes, seconds):
+    commentiobytes.observe(nbytes, operation)
+    commentioseconds.observe(seconds, operation)
+
+def observe_comment_lock_wait(seconds):
+    commentlockwaitseconds.observe(seconds, "database")
+
+# number of comments in each open comment store, for /metrics
+def get_comment_counts():
+    with commentfilelock:
+        opencommentlogs = list(commentlogs.values())
+    return {(getattr(commentlog, "showname", None) or os.path.splitext(os.path.basename(commentlog.path))[0],): commentlog.count()
+        for commentlog in opencommentlogs}
+
+# import comment log & JSON comment files in COMMENTSDIR into the SQLite comment database, returns number of comments imported
+# files are named after sanitized show names, so they're matched back up with shows on the schedule where possible
+# imported files are renamed to <<FILENAME>>.imported
+def import_comment_files():
+    shownames = {pathvalidate.sanitize_filename(showname): showname for showname in get_all_shows()}
+    imported = 0
+    for commentfile in sorted(glob.glob("%s/*.log" % COMMENTSDIR) + glob.glob("%s/*.json" % COMMENTSDIR)):
+        filename, extension = os.path.splitext(os.path.basename(commentfile))
+        if extension == ".log":
+            comments = CommentLog(commentfile, flaskapp.config['MAX_COMMENTS']).get_comments()
+        else:
+            comments = read_json(commentfile)
+            if comments is None:
+                logging.error("Error importing comments: %s is not valid JSON" % commentfile)
+                continue
+        get_comment_log(shownames.get(filename, filename)).import_comments(comments)
+        os.rename(commentfile, "%s.imported" % commentfile)
+        imported += len(comments)
+        logging.info("Imported %d comments from %s" % (len(comments), commentfile))
+    return imported
+
+# swap in a new stream status snapshot, storing it in the state backend unless share is False
+def publish_stream_status(showrunning, showname, checktime, share=True, mount=None):
     global streamstatus
-
-    if time.time() - streamstatus['check_time'] >= 5.0:
-        update_stream_status()
-
-    return streamstatus['show_name']
-
-# get current comment filename
-def get_comment_file():
-    return "%s/%s.json" % (COMMENTSDIR, pathvalidate.sanitize_filename(get_current_showname()))
-
+    currentstatus = get_mount_status(mount)
+    # archive the comments of a show that's just ended in the background, from the worker that saw it end
+    if share and flaskapp.config['ARCHIVE_COMMENTS'] and currentstatus.show_running and currentstatus.show_name \
+            and (not showrunning or showname != currentstatus.show_name):
+        tasksched.add_job(func=archive_show_comments, args=[currentstatus.show_name, mount])
+    generation = currentstatus.generation
+    if showrunning != currentstatus.show_running or showname != currentstatus.show_name:
+        generation += 1
+    newstatus = StreamStatus(showrunning, showname, checktime, generation)
+    if mount is None:
+        streamstatus = newstatus
+    else:
+        mountstatuses[mount] = newstatus
+    if generation != currentstatus.generation:
+        request_snapshot()
+    if share and statebackend.shared:
+        key = "streamstatus" if mount is None else "streamstatus@%s" % mount
+        syncedversions[key] = statebackend.set(key, [showrunning, showname, checktime])
+
+# bring the static snapshots up to date, if they're turned on, after a change that could affect them
+def request_snapshot():
+    if snapshotpublisher is not None:
+        snapshotpublisher.request()
+
+# the snapshot file of the comment room on the main mountpoint or the given one, relative to SNAPSHOT_DIRECTORY
+def get_snapshot_file(mount=None):
+    return "comments.json" if mount is None else "comments-%s.json" % pathvalidate.sanitize_filename(mount)
+
+# the body of each comment room's snapshot, as served on GET /comments, for the snapshot publisher
+# returns [(snapshot file, version, EncodedBody)...], with the room in the version, so a new show's comments are always written
+def render_snapshots():
+    # pick up schedule & stream status changes from other workers
+    sync_shared_state(force=True)
+    snapshots = []
+    for mount in [None] + list(mountstatuses):
+        if views.check_comments_enabled(mount):
+            showname = get_current_showname(mount)
+            etag, body = get_comment_log(showname, mount).get_comments_body()
+            snapshots.append((get_snapshot_file(mount), "%s/%s" % (get_room_name(showname, mount), etag), body))
+        else:
+            # None, indicating comments are disabled at this point
+            snapshots.append((get_snapshot_file(mount), "null", EncodedBody(b"null")))
+    return snapshots
+
+# index of the sources in an Icecast status obj by mountpoint name, built in a single pass
+def index_sources(status):
+    sources = status.get('icestats', {}).get('source', [])
+    # when only one mountpoint is present, it's not collected into an array, which is annoying
+    if type(sources) != type([]):
+        sources = [sources]
+    return {source['listenurl'].rpartition("/")[2]: source for source in sources if 'listenurl' in source}
+
+# scheduled by start_scheduler() to run every STREAM_STATUS_INTERVAL seconds
+# updates the status of the main mountpoint & every other one with a comment room
 def update_stream_status():
     currentstatus = get_stream_status()
-
-    if 'icestats' in currentstatus and 'source' in currentstatus['icestats']:
-        # when multiple mountpoints are present, they're collected into a JSON array
-        # iterate through them to find the main one
-        if type(currentstatus['icestats']['source']) == type([]):
-            streamstatus['show_running'] = False
-            streamstatus['show_name'] = ""
-            for show in currentstatus['icestats']['source']:
-                if show['listenurl'].split("/")[-1] == flaskapp.config['MAIN_MOUNTPOINT'] and 'stream_start' in show:
-                    streamstatus['show_running'] = True
-                    streamstatus['show_name'] = show['server_name']
-
-        # if only one mountpoint is present, it's not collected into an array, which is annoying
-        else:
-            show = currentstatus['icestats']['source']
-            streamstatus['show_running'] = (show['listenurl'].split("/")[-1] == flaskapp.config['MAIN_MOUNTPOINT'] and 'stream_start' in show)
-            streamstatus['show_name'] = show['server_name'] if 'server_name' in show else ""
-    else:
-        streamstatus['show_running'] = False
-        streamstatus['show_name'] = ""
-
-    streamstatus['check_time'] = time.time()
+    mounts = [None] + list(mountstatuses.keys())
+
+    # Icecast unreachable - keep serving the last known status until it's too old to trust
+    if currentstatus is None:
+        for mount in mounts:
+            mountstatus = get_mount_status(mount)
+            if mountstatus.show_running and time.time() - mountstatus.check_time > flaskapp.config['ICECAST_MAX_STALENESS']:
+                logging.error("Icecast status older than %d seconds, treating show on %s as not running" % (flaskapp.config['ICECAST_MAX_STALENESS'],
+                    mount or flaskapp.config['MAIN_MOUNTPOINT']))
+                publish_stream_status(False, "", mountstatus.check_time, mount=mount)
+        return
+
+    sources = index_sources(currentstatus)
+    checktime = time.time()
+    for mount in mounts:
+        source = sources.get(mount or flaskapp.config['MAIN_MOUNTPOINT'])
+        showrunning = source is not None and 'stream_start' in source
+        publish_stream_status(showrunning, source.get('server_name', "") if showrunning else "", checktime, mount=mount)
+
+# get event queue for stream subscribers of the given show, or the current show if none is given
+# comment stores publish their changes to it, so it's created along with the show's store
+def get_broadcaster(showname=None, mount=None):
+    if showname is None:
+        showname = get_current_showname(mount)
+    commentkey = get_comment_key(get_room_name(showname, mount))
+    broadcaster = broadcasters.get(commentkey)
+    if broadcaster is None:
+        get_comment_log(showname, mount)
+        broadcaster = broadcasters[commentkey]
+    return broadcaster
+
+# add a comment to the current show on the main mountpoint or the given one, returning its id, or None if the comment section is full
+# with COMMENT_INGEST set to "queue", this waits up to INGEST_TIMEOUT seconds for the comment's batch to be committed,
+# raising concurrent.futures.TimeoutError if it isn't
+def store_comment(name, comment, mount=None):
+    commentlog = get_comment_log(mount=mount)
+    if ingestqueue is not None:
+        future = ingestqueue.submit(commentlog, name, comment)
+        try:
+            return future.result(timeout=flaskapp.config['INGEST_TIMEOUT'])
+        except concurrent.futures.TimeoutError:
+            # drop the comment if it's still waiting, so it isn't stored after all once the poster's been told it failed
+            future.cancel()
+            raise
+    return commentlog.add(name, comment)
+
+# whether a client may post another comment, going by its address, and the name it posts under if COMMENT_RATE_BY_NAME
+def check_comment_rate(clientaddr, name):
+    if commentratelimits is None:
+        return True
+    addrallowed = commentratelimits.allow(("addr", clientaddr))
+    if not flaskapp.config['COMMENT_RATE_BY_NAME']:
+        return addrallowed
+    # take from both buckets, so neither switching names nor switching addresses gets around the limit
+    nameallowed = commentratelimits.allow(("name", " ".join(name.lower().split())))
+    return addrallowed and nameallowed
+
+# take a login attempt from the buckets for the client's address & the username it gives, returns whether it may try
+# taken before the password is checked, so a burst of parallel attempts can't all get in before the first failure counts
+def take_login_attempt(clientaddr, username):
+    if loginfailurelimits is None:
+        return True
+    if not loginfailurelimits.allow(("addr", clientaddr)):
+        return False
+    if not loginfailurelimits.allow(("user", username)):
+        loginfailurelimits.refund(("addr", clientaddr))
+        return False
+    return True
+
+# hand back an attempt taken by take_login_attempt, for anything but a failed login
+def refund_login_attempt(clientaddr, username):
+    if loginfailurelimits is not None:
+        loginfailurelimits.refund(("addr", clientaddr))
+        loginfailurelimits.refund(("user", username))
+
+# whether a client has attempts left, going by the failed logins from its address & for the username it gives
+def check_login_rate(clientaddr, username):
+    if loginfailurelimits is None:
+        return True
+    return loginfailurelimits.available(("addr", clientaddr)) and loginfailurelimits.available(("user", username))
+
+# whether a comment repeats one recently posted under the same name to the current show on the main mountpoint or the given one
+# a comment that isn't a repeat is remembered, and should be forgotten with forget_duplicate_comment if it's not stored
+def check_duplicate_comment(name, comment, mount=None):
+    if flaskapp.config['DUPLICATE_WINDOW'] <= 0:
+        return False
+    return get_duplicate_filter(mount).check(name, comment)
+
+# forget a comment remembered by check_duplicate_comment, so that it may be posted again
+def forget_duplicate_comment(name, comment, mount=None):
+    if flaskapp.config['DUPLICATE_WINDOW'] > 0:
+        get_duplicate_filter(mount).forget(name, comment)
+
+def get_duplicate_filter(mount=None):
+    commentkey = get_comment_key(get_room_name(get_current_showname(mount), mount))
+    with commentfilelock:
+        duplicatefilter = duplicatefilters.get(commentkey)
+        if duplicatefilter is None:
+            duplicatefilter = duplicatefilters[commentkey] = DuplicateFilter(flaskapp.config['DUPLICATE_WINDOW'])
+    return duplicatefilter
 
 # returns a list of all unique shows on the schedule, in alphabetical order
 def get_all_shows():
-    shows = []
-    if schedobj:
-        for day in schedobj:
-            for hour in day.keys():
-                if not day[hour]['show'] in shows:
-                    shows.append(day[hour]['show'])
-    shows.sort(key=lambda x: x.lower())
-    return shows
+    return list(schedindex.shows)
+
+# returns (show name, mountpoint) of every room on COMMENT_MOUNTPOINTS an admin can set comments for - the one
+# each mountpoint is currently streaming, and any given a setting before - in alphabetical order
+def get_all_rooms():
+    rooms = set()
+    for mount, mountstatus in mountstatuses.items():
+        if mountstatus.show_name:
+            rooms.add((mountstatus.show_name, mount))
+    for room in roomsettings[1]:
+        showname, _, mount = room.rpartition("@")
+        if mount in mountstatuses:
+            rooms.add((showname, mount))
+    return sorted(rooms, key=lambda room: (room[0].lower(), room[1]))
 
 
 # scheduled methods
 
 # pull authoritative schedule from provided URL or path
+# the source is only fetched & reconciled when it's changed since the last refresh, and the schedule only saved if that changed it
 def refresh_schedule():
+    global schedulesource
+    start = time.perf_counter()
     try:
         path = flaskapp.config['SOURCE_SCHEDULE_LOCATION']
 
-        inputschedobj = None
-        # if path begins with http:// or https://, download and load it using requests
-        if re.match("http[s]?://", path):
-            # pull html site
-            inputschedresp = requests.get(path)
-            if inputschedresp.status_code == 200:
-                inputschedobj = json.loads(inputschedresp.text)
+        changed, inputschedobj, source = fetch_source_schedule(path)
+        if changed:
+            if not inputschedobj:
+                raise FileNotFoundError("Schedule file at %s not found." % path)
+            elif len(inputschedobj) != 7:
+                raise ValueError("Schedule file does not contain seven days worth of shows")
+
+        with statebackend.lock("schedule"):
+            sync_shared_state(force=True)
+
+            # reconcile the internal schedule with the input, keeping comment settings of shows that haven't moved
+            diff = diff_schedule(schedindex.schedobj, inputschedobj, get_show_comment_setting) if changed else {}
+            if diff:
+                schedobj = apply_schedule_diff(schedindex.schedobj, diff)
+                write_schedule(schedobj)
+                publish_schedule(schedobj)
+            elif not os.path.exists(SCHEDULEFILE):
+                # schedule file has gone missing, so save the current schedule again
+                write_schedule(schedindex.schedobj)
+
+        schedulesource = source
+        if changed:
+            logging.info("Updated schedule: %d timeslots changed" % len(diff))
         else:
-            if os.path.exists(path):
-                with open(path) as inputschedfile:
-                    inputschedobj = json.load(inputschedfile)
-
-        if not schedobj:
-            raise FileNotFoundError("Schedule file at %s not found." % path)
-        elif len(schedobj) != 7:
-            raise ValueError("Schedule file does not contain seven days worth of shows")
-
-        # iterate through days & hours in both schedule objects and reconcile internal one with input
-        for day in range(7):
-            schedday = schedobj[day]
-            inputschedday = inputschedobj[day]
-            for hournum in range(24):
-                hour = str(hournum)
-                if hour in inputschedday:
-                    if hour not in schedday or inputschedday[hour]['show'] != schedday[hour]['show']:
-                        schedday[hour] = {
-                            'show'      : inputschedday[hour]['show'],
-                            'comments'  : get_show_comment_setting(inputschedday[hour]['show'])
-                        }
-                elif hour in schedday:
-                    schedday.pop(hour)
-                
-        # save output schedule
-        with open(SCHEDULEFILE, mode="w") as schedfile:
-            json.dump(schedobj, schedfile)
-
-        logging.info("Updated schedule")
+            logging.info("Schedule source unchanged")
+        schedulerefreshseconds.observe(time.perf_counter() - start, "ok")
 
     except Exception as err:
+        schedulerefreshseconds.observe(time.perf_counter() - start, "error")
         _, _, exc_tb = sys.exc_info()
         logging.error("Error updating schedule: %s: %s at line %d" % (err.__class__.__name__, str(err), exc_tb.tb_lineno))
 
-# delete all comment files daily
+# fetch the source schedule from a URL or path, unless its validators show it's unchanged since the last one applied
+# returns (whether it changed, schedule obj or None if not found, validators)
+def fetch_source_schedule(path):
+    lastsource = schedulesource if schedulesource.get('location') == path else {}
+    # if path begins with http:// or https://, download it with a conditional request
+    if re.match("http[s]?://", path):
+        headers = {}
+        if lastsource.get('etag'):
+            headers['If-None-Match'] = lastsource['etag']
+        if lastsource.get('lastmodified'):
+            headers['If-Modified-Since'] = lastsource['lastmodified']
+        inputschedresp = requests.get(path, headers=headers, timeout=flaskapp.config['SCHEDULE_SOURCE_TIMEOUT'])
+        if inputschedresp.status_code == 304:
+            return False, None, lastsource
+        source = {
+            'location'      : path,
+            'etag'          : inputschedresp.headers.get("ETag"),
+            'lastmodified'  : inputschedresp.headers.get("Last-Modified")
+        }
+        return True, json.loads(inputschedresp.text) if inputschedresp.status_code == 200 else None, source
+    if not os.path.exists(path):
+        return True, None, {}
+    with open(path) as inputschedfile:
+        stat = os.fstat(inputschedfile.fileno())
+        source = {
+            'location'  : path,
+            'mtime'     : stat.st_mtime_ns,
+            'size'      : stat.st_size
+        }
+        if source == lastsource:
+            return False, None, lastsource
+        return True, json.load(inputschedfile), source
+
+# archive & remove comments past their retention, run daily by CLEAR_COMMENTS_CRON
+# comments from episodes that ended over COMMENT_RETENTION_DAYS days ago are archived, then deleted - with log storage,
+# all of them with 0, and comments in logs written before episodes were recorded go by the log's last write
+# shows are handled one at a time, each only holding off writers to its own comments while it's archived
 def clear_comments():
-    commentfiles = glob.glob("%s/*" % COMMENTSDIR)
-    for commentfile in commentfiles:
-        os.remove(commentfile)
-    if flaskapp.debug:
-        print("removed comments from %s" % COMMENTSDIR)
+    archiving = flaskapp.config['ARCHIVE_COMMENTS']
+    retention = flaskapp.config['COMMENT_RETENTION_DAYS']
+    before = get_episode(datetime.datetime.now() - datetime.timedelta(days=retention))
+    if commentdb is not None:
+        if archiving:
+            pruned = commentdb.archive_episodes(before, lambda showname, episode, comments:
+                write_archive(get_archive_file(showname, episode), comments, flaskapp.config['WRITE_DURABILITY']))
+        else:
+            pruned = commentdb.prune(before)
+        logging.info("Pruned %d comments from %s" % (pruned, commentdb.path))
+    else:
+        pruned = 0
+        for commentfile in glob.glob("%s/*.log" % COMMENTSDIR):
+            # cleared through its open store, so requests already holding it don't write to a stale object
+            showname = os.path.basename(commentfile)[:-len(".log")]
+            pruned += prune_comment_log(get_comment_store(commentfile, showname), showname, before if retention else None)
+        logging.info("Pruned %d comments from %s" % (pruned, COMMENTSDIR))
+        # JSON comment files left by an older version of the server, archived under the episode they were last written in
+        for commentfile in glob.glob("%s/*.json" % COMMENTSDIR):
+            comments = read_json(commentfile)
+            if comments is None:
+                # leave it for an admin to look at, rather than losing the comments in it
+                logging.error("Error archiving comments: %s is not valid JSON" % commentfile)
+                continue
+            if archiving and comments:
+                showname = os.path.basename(commentfile)[:-len(".json")]
+                episode = get_episode(datetime.datetime.fromtimestamp(os.path.getmtime(commentfile)))
+                write_archive(get_archive_file(showname, episode), ((commentid, comments[commentid]) for commentid in sorted(comments, key=int)),
+                    flaskapp.config['WRITE_DURABILITY'])
+            os.remove(commentfile)
+        if flaskapp.debug:
+            print("removed comments from %s" % COMMENTSDIR)
+    if flaskapp.config['ARCHIVE_RETENTION_DAYS'] > 0:
+        before = get_episode(datetime.datetime.now() - datetime.timedelta(days=flaskapp.config['ARCHIVE_RETENTION_DAYS']))
+        logging.info("Pruned archived comments of %d episodes" % prune_archives(ARCHIVEDIR, before))
+
+# archive file of a show's comments from the given episode
+def get_archive_file(showname, episode):
+    return "%s/%s/%s.jsonl.gz" % (ARCHIVEDIR, episode, pathvalidate.sanitize_filename(showname))
+
+# write a comment store's comments to the archive, clearing them afterwards if clear is set
+# comments are archived under the episode they were posted in - those in logs written before episodes were recorded
+# are archived under the episode the log was last written in
+def archive_comment_store(commentlog, showname, clear=False):
+    if commentdb is not None:
+        defaultepisode = None
+    elif os.path.exists(commentlog.path):
+        defaultepisode = get_log_episode(commentlog)
+    else:
+        # nothing has been written to this log
+        return
+    commentlog.archive(lambda episode, comments: write_archive(get_archive_file(showname, episode), comments, flaskapp.config['WRITE_DURABILITY']),
+        clear, defaultepisode)
+
+# delete a comment log's comments from episodes before the given one, or all of them if it's None, archiving them first
+# if ARCHIVE_COMMENTS is set - returns the number deleted
+def prune_comment_log(commentlog, showname, before=None):
+    if not os.path.exists(commentlog.path):
+        return 0
+    write = None
+    if flaskapp.config['ARCHIVE_COMMENTS']:
+        write = lambda episode, comments: write_archive(get_archive_file(showname, episode), comments, flaskapp.config['WRITE_DURABILITY'])
+    return commentlog.archive_episodes(before, write, get_log_episode(commentlog))
+
+# episode a comment log was last written in, which its comments recorded without an episode are taken to be from
+def get_log_episode(commentlog):
+    return get_episode(datetime.datetime.fromtimestamp(os.path.getmtime(commentlog.path)))
+
+# archive the comments of a show that's just ended on the main mountpoint or the given one, leaving them live until they're cleared
+def archive_show_comments(showname, mount=None):
+    room = get_room_name(showname, mount)
+    try:
+        archive_comment_store(get_comment_log(showname, mount), room)
+        logging.info("Archived comments for %s" % room)
+    except Exception as err:
+        _, _, exc_tb = sys.exc_info()
+        logging.error("Error archiving comments for %s: %s: %s at line %d" % (room, err.__class__.__name__, str(err), exc_tb.tb_lineno))
+
+# generator over a show's archived comments from the given episode, as (id, {name, comment}) pairs
+def read_archived_comments(showname, episode):
+    return read_archive(get_archive_file(showname, episode))
+
+# log queue depth & batch sizes of the comment ingest queue
+def log_ingest_metrics():
+    logging.info("Comment ingest: %(depth)d queued, %(committed)d comments committed in %(batches)d batches, "
+        "last batch %(lastbatch)d, largest %(largestbatch)d, average %(averagebatch).1f" % ingestqueue.get_metrics())
+
+# fsync outstanding log records & rewrite logs that have built up enough deleted comments
+# every worker fsyncs its own writes, but only the elected one compacts
+def compact_comments():
+    with commentfilelock:
+        opencommentlogs = list(commentlogs.values())
+    leader = statebackend.elect_leader()
+    for commentlog in opencommentlogs:
+        try:
+            commentlog.sync()
+            if leader and commentlog.compact(flaskapp.config['COMMENT_LOG_COMPACT_THRESHOLD']):
+                logging.info("Compacted comment log %s" % commentlog.path)
+        except Exception as err:
+            _, _, exc_tb = sys.exc_info()
+            logging.error("Error compacting comment log %s: %s: %s at line %d" % (commentlog.path, err.__class__.__name__, str(err), exc_tb.tb_lineno))
 
-main()
 from app import views
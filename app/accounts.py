@@ -0,0 +1,87 @@
+# --------------------------------------------------------------------
+#   accounts.py - admin console accounts
+# --------------------------------------------------------------------
+
+import hashlib
+import hmac
+import json
+import logging
+import os
+import stat
+from threading import Lock
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from .durable import write_json
+
+# accounts are kept as a JSON dictionary of username -> salted password hash, as made by werkzeug's generate_password_hash:
+#   {"account1" : "pbkdf2:sha256:150000$<<SALT>>$<<HASH>>"}
+# plaintext passwords are still accepted, so existing account files keep working until they're hashed with
+# "python3 manage.py hash-passwords"
+
+# whether an account file value is a password hash rather than a plaintext password
+def is_password_hash(value):
+    if value.count("$") < 2:
+        return False
+    method = value.split("$", 1)[0]
+    return method.startswith("pbkdf2:") or method in hashlib.algorithms_guaranteed
+
+# the accounts in an account file, read once & read again only when the file's mtime or size changes,
+# so login attempts don't each cost a parse of the file
+class AccountStore:
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        # (mtime_ns, size) of the file the accounts were read from, None while it doesn't exist
+        self.signature = None
+        # username -> password hash or plaintext password, None while the file doesn't exist
+        self.accounts = None
+        # checked against for unknown users, so they take as long to turn away as wrong passwords
+        self.dummyhash = None
+
+    # the current accounts, or None if the account file doesn't exist
+    def get_accounts(self):
+        try:
+            filestat = os.stat(self.path)
+            signature = (filestat.st_mtime_ns, filestat.st_size)
+        except FileNotFoundError:
+            signature = None
+        with self.lock:
+            if signature != self.signature:
+                self.accounts = self.load() if signature is not None else None
+                self.signature = signature
+            return self.accounts
+
+    def load(self):
+        with open(self.path) as accountfile:
+            accounts = json.load(accountfile)
+        plaintext = sum(1 for password in accounts.values() if not is_password_hash(password))
+        if plaintext:
+            logging.warning("%d accounts in %s have plaintext passwords, run \"python3 manage.py hash-passwords\" to hash them" % (plaintext, self.path))
+        return accounts
+
+    # whether the password is right for the user, compared in constant time
+    def check(self, username, password):
+        stored = (self.get_accounts() or {}).get(username)
+        if stored is None:
+            if self.dummyhash is None:
+                self.dummyhash = generate_password_hash("")
+            check_password_hash(self.dummyhash, password)
+            return False
+        if is_password_hash(stored):
+            return check_password_hash(stored, password)
+        return hmac.compare_digest(stored.encode("utf-8"), password.encode("utf-8"))
+
+# replace every plaintext password in an account file with a salted hash, keeping the file's permissions
+# returns the number of passwords hashed
+def hash_passwords(path, durability="full"):
+    with open(path) as accountfile:
+        accounts = json.load(accountfile)
+    plaintext = [username for username, password in accounts.items() if not is_password_hash(password)]
+    if plaintext:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+        for username in plaintext:
+            accounts[username] = generate_password_hash(accounts[username])
+        # no previous generation is kept, since it would hold the plaintext passwords
+        write_json(path, accounts, durability, mode=mode)
+    return len(plaintext)
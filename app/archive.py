@@ -0,0 +1,52 @@
+# --------------------------------------------------------------------
+#   archive.py - compressed archives of past comments
+# --------------------------------------------------------------------
+
+import gzip
+import json
+import os
+import shutil
+import zlib
+
+from .durable import write_file
+
+# archived comments are kept as gzipped JSON lines, one file per show per episode, under a directory per episode:
+#   <<ARCHIVE DIRECTORY>>/<<YYYY-MM-DD>>/<<SANITIZED SHOW NAME>>.jsonl.gz
+# holding one {"id": 3, "name": "...", "comment": "..."} record per line, in id order
+# files are rewritten whole each time a show is archived, so archiving the same episode again is harmless
+
+# write (id, {name, comment}) pairs to an archive file, compressing them as they're read,
+# so a whole episode never has to be held in memory in either form
+def write_archive(path, comments, durability="full"):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return write_file(path, compress_records(comments), durability)
+
+def compress_records(comments):
+    # wbits of 31 produces a gzip stream
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for commentid, comment in comments:
+        record = {'id': int(commentid), 'name': comment['name'], 'comment': comment['comment']}
+        chunk = compressor.compress((json.dumps(record) + "\n").encode("utf-8"))
+        if chunk:
+            yield chunk
+    yield compressor.flush()
+
+# generator over the (id, {name, comment}) pairs in an archive file, decompressed a line at a time
+def read_archive(path):
+    with gzip.open(path, mode="rt", encoding="utf-8") as archivefile:
+        for line in archivefile:
+            record = json.loads(line)
+            yield str(record['id']), {'name': record['name'], 'comment': record['comment']}
+
+# episodes with archives, oldest first
+def list_episodes(archivedir):
+    if not os.path.isdir(archivedir):
+        return []
+    return sorted(name for name in os.listdir(archivedir) if os.path.isdir(os.path.join(archivedir, name)))
+
+# remove the archives of every episode before the given one, returns the number of episodes removed
+def prune_archives(archivedir, before):
+    pruned = [episode for episode in list_episodes(archivedir) if episode < before]
+    for episode in pruned:
+        shutil.rmtree(os.path.join(archivedir, episode))
+    return len(pruned)
@@ -0,0 +1,253 @@
+# --------------------------------------------------------------------
+#   asgi.py - asyncio serving of the comment read path
+# --------------------------------------------------------------------
+
+import asyncio
+import logging
+import sys
+import time
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.http import parse_accept_header, parse_etags
+
+import app
+from .views import check_comments_enabled, format_event
+from .encoding import encoded_etag
+
+# ASGI application serving GET /comments & /comments/stream on the event loop, and everything else through Flask
+# stream subscribers are plain coroutines woken by their show's broadcaster, so each listener costs a few objects
+# rather than a thread, and storage calls that can block on disk or SQLite are handed to the default thread pool
+# schedule, stream status & comment stores are the same ones the Flask app uses, kept up by its background jobs
+class CommentServerASGI:
+    def __init__(self, flaskapp):
+        self.wsgiapp = WsgiToAsgi(flaskapp)
+        self.routes = {
+            "/comments"         : self.get_comments,
+            "/comments/stream"  : self.stream_comments
+        }
+        self.loop = None
+        # broadcaster -> set of asyncio.Event, one per stream subscriber, only touched on the event loop
+        self.subscribers = {}
+        # broadcasters that have had a wake-up callback added for this loop
+        self.hooked = set()
+        # task syncing shared state & polling comment stores for changes made by other processes
+        self.poller = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        route = self.routes.get(scope['path']) if scope['type'] == "http" and scope['method'] == "GET" else None
+        if route is None:
+            await self.wsgiapp(scope, receive, send)
+            return
+        self.start()
+        start = time.perf_counter()
+        status = await route(scope, receive, send)
+        app.requestseconds.observe(time.perf_counter() - start, scope['path'], "GET", status)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == "lifespan.startup":
+                self.start()
+                await send({'type': "lifespan.startup.complete"})
+            elif message['type'] == "lifespan.shutdown":
+                if self.poller is not None:
+                    self.poller.cancel()
+                await send({'type': "lifespan.shutdown.complete"})
+                return
+
+    # servers without lifespan support get started on their first request
+    def start(self):
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+            if app.statebackend.shared or app.commentdb is not None:
+                self.poller = self.loop.create_task(self.poll())
+
+    # storage calls always run in the thread pool - even the local log store, served from memory once open,
+    # replays its log on first open and shares one lock between readers & writers, so a read can wait out a
+    # writer's fsync, which would stall every other request on the loop
+    async def run_store(self, func, *args):
+        return await self.loop.run_in_executor(None, func, *args)
+
+    # periodically pick up changes made by other processes, in place of the per-request sync & per-stream polling
+    # the Flask app does, so the cost doesn't grow with the number of listeners
+    async def poll(self):
+        while True:
+            await asyncio.sleep(app.flaskapp.config['STATE_SYNC_INTERVAL'])
+            try:
+                await self.loop.run_in_executor(None, self.poll_stores, set(self.subscribers))
+            except Exception as err:
+                _, _, exc_tb = sys.exc_info()
+                logging.error("Error polling for comment changes: %s: %s at line %d" % (err.__class__.__name__, str(err), exc_tb.tb_lineno))
+
+    # only stores with stream subscribers need polling
+    def poll_stores(self, broadcasters):
+        app.sync_shared_state()
+        with app.commentfilelock:
+            polled = [commentlog for key, commentlog in app.commentlogs.items() if app.broadcasters.get(key) in broadcasters]
+        for commentlog in polled:
+            commentlog.poll()
+
+    # GET /comments, as served by the Flask app
+    async def get_comments(self, scope, receive, send):
+        headers = self.get_headers(scope)
+        args = parse_qs(scope['query_string'].decode("latin-1"))
+        mount = self.get_mount(args)
+        try:
+            if not check_comments_enabled(mount):
+                # return None, indicating comments are disabled at this point
+                return await self.respond(send, 200, b"null", headers)
+            since = args.get("since", [""])[0]
+            since = int(since) if since.isdigit() else None
+            etag, body = await self.run_store(self.read_comments, since, mount)
+            encoding = body.choose(parse_accept_header(headers.get("accept-encoding")))
+            etag = encoded_etag(etag, encoding)
+            # nothing has changed since the client's last fetch
+            if etag in parse_etags(headers.get("if-none-match")):
+                return await self.respond(send, 304, b"", headers, etag)
+            return await self.respond(send, 200, body.get(encoding), headers, etag, encoding)
+        except Exception as err:
+            _, _, exc_tb = sys.exc_info()
+            logging.error("Error returning comments: %s: %s at line %d" % (err.__class__.__name__, str(err), exc_tb.tb_lineno))
+            return await self.respond(send, 200, b"error", headers)
+
+    def read_comments(self, since, mount):
+        return app.get_comment_log(mount=mount).get_comments_body(since)
+
+    # mountpoint of the comment room a request is for, see get_request_mount in views.py
+    def get_mount(self, args):
+        mount = args.get("mount", [""])[0]
+        if not mount or mount == app.flaskapp.config['MAIN_MOUNTPOINT']:
+            return None
+        return mount
+
+    # GET /comments/stream, as served by the Flask app
+    async def stream_comments(self, scope, receive, send):
+        headers = self.get_headers(scope)
+        args = parse_qs(scope['query_string'].decode("latin-1"))
+        since = args.get("since", [""])[0]
+        since = int(since) if since.isdigit() else None
+        if since is None and headers.get("last-event-id", "").isdigit():
+            since = int(headers["last-event-id"])
+
+        await send({
+            'type'      : "http.response.start",
+            'status'    : 200,
+            'headers'   : self.cors_headers(headers) + [(b"content-type", b"text/event-stream; charset=utf-8"),
+                (b"cache-control", b"no-cache"), (b"x-accel-buffering", b"no")]
+        })
+
+        wake = asyncio.Event()
+        disconnected = []
+        async def watch_disconnect():
+            while (await receive())['type'] != "http.disconnect":
+                pass
+            disconnected.append(True)
+            wake.set()
+        watcher = self.loop.create_task(watch_disconnect())
+        try:
+            async for chunk in self.comment_events(since, self.get_mount(args), wake, disconnected):
+                await send({'type': "http.response.body", 'body': chunk.encode("utf-8"), 'more_body': True})
+            await send({'type': "http.response.body", 'body': b"", 'more_body': False})
+        finally:
+            watcher.cancel()
+        return 200
+
+    # same events as comment_event_stream in views.py, waiting on the event loop instead of in Broadcaster.wait
+    async def comment_events(self, since, mount, wake, disconnected):
+        yield "retry: %d\n\n" % (app.flaskapp.config['STREAM_RETRY_INTERVAL'] * 1000)
+
+        if not check_comments_enabled(mount):
+            yield format_event("disabled", None)
+            return
+
+        showname = app.get_current_showname(mount)
+        commentlog = await self.run_store(app.get_comment_log, showname, mount)
+        broadcaster = app.get_broadcaster(showname, mount)
+        self.subscribe(broadcaster, wake)
+        try:
+            # note the broadcast position before taking the snapshot, so no comment can fall between the two
+            lastseq = broadcaster.seq
+            comments = await self.run_store(commentlog.get_comments, since)
+            yield format_event("comments", comments, max(comments.keys(), key=int) if comments else None)
+
+            heartbeatinterval = app.flaskapp.config['STREAM_HEARTBEAT_INTERVAL']
+            # with other processes involved, recheck the show & comment setting as often as the poller syncs them
+            polling = app.statebackend.shared or app.commentdb is not None
+            waitinterval = min(heartbeatinterval, app.flaskapp.config['STATE_SYNC_INTERVAL']) if polling else heartbeatinterval
+            lastsent = time.time()
+
+            while not disconnected:
+                try:
+                    await asyncio.wait_for(wake.wait(), waitinterval)
+                except asyncio.TimeoutError:
+                    pass
+                wake.clear()
+                if disconnected:
+                    return
+                lastseq, events, missed = broadcaster.wait(lastseq, 0)
+
+                # this subscriber fell behind the backlog, so resend the whole comment set
+                if missed:
+                    yield format_event("comments", await self.run_store(commentlog.get_comments))
+                else:
+                    for _, event, data in events:
+                        yield format_event(event, data, next(iter(data)) if event == "comment" else None)
+
+                if events:
+                    lastsent = time.time()
+                elif time.time() - lastsent >= heartbeatinterval:
+                    yield ": heartbeat\n\n"
+                    lastsent = time.time()
+
+                if app.get_current_showname(mount) != showname:
+                    yield format_event("show", app.get_current_showname(mount))
+                    return
+                if not check_comments_enabled(mount):
+                    yield format_event("disabled", None)
+                    return
+        finally:
+            self.unsubscribe(broadcaster, wake)
+
+    def subscribe(self, broadcaster, wake):
+        self.subscribers.setdefault(broadcaster, set()).add(wake)
+        if broadcaster not in self.hooked:
+            self.hooked.add(broadcaster)
+            # one callback per broadcaster, which wakes all of its subscribers in a single trip to the loop
+            broadcaster.add_callback(lambda: self.loop.call_soon_threadsafe(self.wake_subscribers, broadcaster))
+
+    def unsubscribe(self, broadcaster, wake):
+        subscribers = self.subscribers.get(broadcaster)
+        subscribers.discard(wake)
+        if not subscribers:
+            del self.subscribers[broadcaster]
+
+    def wake_subscribers(self, broadcaster):
+        for wake in self.subscribers.get(broadcaster, ()):
+            wake.set()
+
+    # request headers, with lowercased names
+    def get_headers(self, scope):
+        return {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope['headers']}
+
+    # same CORS headers Flask-CORS adds to the Flask app's responses
+    def cors_headers(self, headers):
+        if "origin" in headers:
+            return [(b"access-control-allow-origin", headers["origin"].encode("latin-1")), (b"vary", b"Origin")]
+        return [(b"access-control-allow-origin", b"*")]
+
+    async def respond(self, send, status, body, headers, etag=None, encoding="identity"):
+        responseheaders = self.cors_headers(headers) + [(b"content-type", b"text/html; charset=utf-8"), (b"content-length", str(len(body)).encode())]
+        if etag is not None:
+            responseheaders.extend([(b"etag", ('"%s"' % etag).encode("latin-1")), (b"vary", b"Accept-Encoding"),
+                (b"cache-control", app.flaskapp.config['COMMENTS_CACHE_CONTROL'].encode("latin-1"))])
+        if encoding != "identity":
+            responseheaders.append((b"content-encoding", encoding.encode("latin-1")))
+        await send({'type': "http.response.start", 'status': status, 'headers': responseheaders})
+        await send({'type': "http.response.body", 'body': body})
+        return status
+
+application = CommentServerASGI(app.flaskapp)
@@ -0,0 +1,41 @@
+# --------------------------------------------------------------------
+#   broadcast.py - in-memory fan-out of comment events to listeners
+# --------------------------------------------------------------------
+
+from collections import deque
+from threading import Condition
+
+# a single show's event queue, shared by all of its subscribers
+# events are kept in a bounded backlog, tagged with an increasing sequence number,
+# and each subscriber tracks the last sequence number it has seen
+class Broadcaster:
+    def __init__(self, backlog=200):
+        self.condition = Condition()
+        self.events = deque(maxlen=backlog)
+        self.seq = 0
+        # functions called after every publish, from the publishing thread, for subscribers that can't block in wait
+        self.callbacks = []
+
+    # add an event to the backlog and wake up all waiting subscribers
+    def publish(self, event, data):
+        with self.condition:
+            self.seq += 1
+            self.events.append((self.seq, event, data))
+            self.condition.notify_all()
+            callbacks = list(self.callbacks)
+        for callback in callbacks:
+            callback()
+
+    def add_callback(self, callback):
+        with self.condition:
+            self.callbacks.append(callback)
+
+    # wait up to timeout seconds for events after lastseq
+    # returns (latest sequence number, [(seq, event, data)...], whether events were dropped from the backlog before being seen)
+    def wait(self, lastseq, timeout):
+        with self.condition:
+            if self.seq == lastseq:
+                self.condition.wait(timeout)
+            events = [event for event in self.events if event[0] > lastseq]
+            missed = self.seq > lastseq and (not events or events[0][0] > lastseq + 1)
+            return self.seq, events, missed
@@ -0,0 +1,325 @@
+# --------------------------------------------------------------------
+#   commentdb.py - SQLite comment storage
+# --------------------------------------------------------------------
+
+import itertools
+import json
+import sqlite3
+import time
+from threading import Lock, local
+
+from .commentlog import comment_words
+from .encoding import EncodedBody
+
+# one database holding every show's comments, stored as rows of (id, show, episode, name, comment)
+# show names are stored as-is, so shows whose names sanitize to the same filename no longer collide
+# ids are unique across all shows and only ever increase, so they're used directly as comment ids
+# each comment's words, as split up by comment_words, are indexed in the comments_fts full-text table under its id
+class CommentDatabase:
+    def __init__(self, path):
+        self.path = path
+        # sqlite connections can't be shared between threads
+        self.connections = local()
+        conn = self.connect()
+        conn.execute("CREATE TABLE IF NOT EXISTS comments (id INTEGER PRIMARY KEY AUTOINCREMENT, show TEXT NOT NULL, "
+            "episode TEXT NOT NULL, name TEXT NOT NULL, comment TEXT NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS comments_show_episode_id ON comments (show, episode, id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS comments_episode ON comments (episode)")
+        # covers the distinct names of an episode, for filtering comments by name
+        conn.execute("CREATE INDEX IF NOT EXISTS comments_show_episode_name ON comments (show, episode, name)")
+        self.create_word_index(conn)
+
+    # words are split up in Python, so they match the log store's search, and indexed as they're inserted
+    # deleting a comment drops its words however it's deleted, so the cleanup paths needn't know about the index
+    # databases from before the index existed are indexed when it's created, in the same transaction
+    def create_word_index(self, conn):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'comments_fts'").fetchone() is None:
+                conn.execute("CREATE VIRTUAL TABLE comments_fts USING fts5(words, tokenize = \"unicode61 remove_diacritics 0 tokenchars '_'\")")
+                conn.execute("CREATE TRIGGER comments_fts_delete AFTER DELETE ON comments BEGIN "
+                    "DELETE FROM comments_fts WHERE rowid = old.id; END")
+                for commentid, comment in conn.execute("SELECT id, comment FROM comments").fetchall():
+                    self.index_words(conn, commentid, comment)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    # index a newly inserted comment's words, inside the transaction that inserted it
+    def index_words(self, conn, commentid, comment):
+        conn.execute("INSERT INTO comments_fts (rowid, words) VALUES (?, ?)", (commentid, " ".join(comment_words(comment))))
+
+    # each thread gets its own connection, in autocommit mode with explicit transactions around writes
+    # every query below is built from constant strings, so sqlite3's statement cache keeps them prepared
+    def connect(self):
+        conn = getattr(self.connections, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, cached_statements=64)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.connections.conn = conn
+        return conn
+
+    # delete every comment from episodes before the given one, returns the number deleted
+    def prune(self, episode):
+        return self.connect().execute("DELETE FROM comments WHERE episode < ?", (episode,)).rowcount
+
+    # archive & delete every show's comments from episodes before the given one, returns the number of comments deleted
+    # each show's episode is passed to write(showname, episode, comments) as (id, {name, comment}) pairs, read as they're written,
+    # and only deleted once write returns - nothing is added to past episodes, so writers don't need holding off
+    def archive_episodes(self, before, write):
+        conn = self.connect()
+        deleted = 0
+        for showname, episode in conn.execute("SELECT DISTINCT show, episode FROM comments WHERE episode < ?", (before,)).fetchall():
+            rows = conn.execute("SELECT id, name, comment FROM comments WHERE show = ? AND episode = ? ORDER BY id", (showname, episode))
+            write(showname, episode, ((str(commentid), {'name': name, 'comment': comment}) for commentid, name, comment in rows))
+            deleted += conn.execute("DELETE FROM comments WHERE show = ? AND episode = ?", (showname, episode)).rowcount
+        return deleted
+
+    # delete every comment
+    def delete_all(self):
+        return self.connect().execute("DELETE FROM comments").rowcount
+
+# a single show's comments for its current episode, with the same interface as CommentLog
+class ShowComments:
+    def __init__(self, db, showname, maxcomments, episodefunc, listener=None, observer=None, lockobserver=None, compressminsize=0):
+        self.db = db
+        self.showname = showname
+        self.maxcomments = maxcomments
+        # returns the current episode, as a YYYY-MM-DD string
+        self.episodefunc = episodefunc
+        # called as listener(event, data) for every change, see CommentLog
+        self.listener = listener
+        # called as observer(operation, bytes, seconds) after every "read" or "write" of comments, see CommentLog
+        self.observer = observer
+        # called as lockobserver(seconds) with the time every write spent waiting for this process's lock & the database's write lock
+        self.lockobserver = lockobserver
+        # bodies returned by get_comments_body are sent compressed once they're this many bytes or more
+        self.compressminsize = compressminsize
+        self.path = "%s (%s)" % (db.path, showname)
+        self.lock = Lock()
+        # what this process last saw of the episode, used by poll to find changes made by other processes
+        self.episode = episodefunc()
+        self.knownids = self.get_ids(db.connect(), self.episode)
+        self.signature = self.get_signature(db.connect(), self.episode)
+        # serialized (and compressed) comment set, and the signature it was built for
+        self.commentsbody = (None, None)
+
+    def notify(self, event, data):
+        if self.listener is not None:
+            self.listener(event, data)
+
+    # take the database's write lock up front, once this process's lock is held - waitstart is when the wait for that began
+    def begin_write(self, conn, waitstart):
+        conn.execute("BEGIN IMMEDIATE")
+        if self.lockobserver is not None:
+            self.lockobserver(time.perf_counter() - waitstart)
+
+    def get_ids(self, conn, episode):
+        return set(row[0] for row in conn.execute("SELECT id FROM comments WHERE show = ? AND episode = ?", (self.showname, episode)))
+
+    # (episode, highest id, count) - since ids only ever increase, this changes whenever the comment set does
+    def get_signature(self, conn, episode):
+        return (episode,) + conn.execute("SELECT MAX(id), COUNT(*) FROM comments WHERE show = ? AND episode = ?", (self.showname, episode)).fetchone()
+
+    # add a new comment, returning its id, or None if the comment section is full
+    def add(self, name, comment):
+        return self.add_many([(name, comment)])[0]
+
+    # add a batch of new comments from a list of (name, comment) in a single transaction, with ids assigned in order
+    # returns the list of their ids, with None for each comment that didn't fit in the comment section
+    def add_many(self, comments):
+        start = time.perf_counter()
+        conn = self.db.connect()
+        episode = self.episodefunc()
+        commentids = []
+        waitstart = time.perf_counter()
+        with self.lock:
+            # take the write lock up front, so the count can't change between checking and inserting
+            self.begin_write(conn, waitstart)
+            try:
+                count = conn.execute("SELECT COUNT(*) FROM comments WHERE show = ? AND episode = ?", (self.showname, episode)).fetchone()[0]
+                for name, comment in comments:
+                    if count >= self.maxcomments:
+                        commentids.append(None)
+                        continue
+                    commentids.append(conn.execute("INSERT INTO comments (show, episode, name, comment) VALUES (?, ?, ?, ?)",
+                        (self.showname, episode, name, comment)).lastrowid)
+                    self.db.index_words(conn, commentids[-1], comment)
+                    count += 1
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            if episode == self.episode:
+                self.knownids.update(commentid for commentid in commentids if commentid is not None)
+        if self.observer is not None:
+            self.observer("write", sum(len(name.encode("utf-8")) + len(comment.encode("utf-8")) for name, comment in comments), time.perf_counter() - start)
+        for commentid, (name, comment) in zip(commentids, comments):
+            if commentid is not None:
+                self.notify("comment", {str(commentid): {'name': name, 'comment': comment}})
+        return [str(commentid) if commentid is not None else None for commentid in commentids]
+
+    # add a set of existing comments in {id: {name, comment}} form to the current episode, under new ids
+    def import_comments(self, comments):
+        conn = self.db.connect()
+        episode = self.episodefunc()
+        waitstart = time.perf_counter()
+        with self.lock:
+            self.begin_write(conn, waitstart)
+            try:
+                for commentid in sorted(comments.keys(), key=int):
+                    newid = conn.execute("INSERT INTO comments (show, episode, name, comment) VALUES (?, ?, ?, ?)",
+                        (self.showname, episode, comments[commentid]['name'], comments[commentid]['comment'])).lastrowid
+                    self.db.index_words(conn, newid, comments[commentid]['comment'])
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    # delete the comment with the given id, returns whether it existed
+    def delete(self, commentid):
+        return len(self.delete_many([commentid])) > 0
+
+    # delete all comments with the given ids in a single transaction
+    # returns the deleted comments, in {id: {name, comment}} form - ids that don't exist are ignored
+    def delete_many(self, commentids):
+        commentids = [int(commentid) for commentid in commentids if commentid.isdigit()]
+        if not commentids:
+            return {}
+        conn = self.db.connect()
+        episode = self.episodefunc()
+        # stay well under sqlite's limit on the number of query parameters
+        batches = [commentids[i:i + 500] for i in range(0, len(commentids), 500)]
+        deleted = {}
+        waitstart = time.perf_counter()
+        with self.lock:
+            self.begin_write(conn, waitstart)
+            try:
+                for batch in batches:
+                    params = (self.showname, episode) + tuple(batch)
+                    placeholders = ",".join("?" * len(batch))
+                    for commentid, name, comment in conn.execute("SELECT id, name, comment FROM comments WHERE show = ? AND episode = ? AND id IN (%s)" % placeholders, params):
+                        deleted[str(commentid)] = {'name': name, 'comment': comment}
+                    conn.execute("DELETE FROM comments WHERE show = ? AND episode = ? AND id IN (%s)" % placeholders, params)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            self.knownids.difference_update(int(commentid) for commentid in deleted)
+        if deleted:
+            self.notify("delete", list(deleted.keys()))
+        return deleted
+
+    # returns the current episode's comments, in {id: {name, comment}} form
+    # if since is given, only comments with a greater id are returned
+    def get_comments(self, since=None):
+        start = time.perf_counter()
+        rows = self.db.connect().execute("SELECT id, name, comment FROM comments WHERE show = ? AND episode = ? AND id > ? ORDER BY id",
+            (self.showname, self.episodefunc(), since or 0))
+        comments = {str(commentid): {'name': name, 'comment': comment} for commentid, name, comment in rows}
+        if self.observer is not None:
+            self.observer("read", sum(len(comment['name'].encode("utf-8")) + len(comment['comment'].encode("utf-8")) for comment in comments.values()),
+                time.perf_counter() - start)
+        return comments
+
+    # number of comments in the current episode
+    def count(self):
+        return self.db.connect().execute("SELECT COUNT(*) FROM comments WHERE show = ? AND episode = ?", (self.showname, self.episodefunc())).fetchone()[0]
+
+    # returns (page, next cursor) for the current episode's comments, see CommentLog.page_comments
+    # both filters run in the database - name matches the episode's distinct names off the (show, episode, name) index,
+    # and text looks up each of its words in comments_fts - and one row past the page tells whether there's another
+    # LIKE only ignores the case of ASCII letters, unlike the log store
+    def page_comments(self, before=None, limit=50, name=None, text=None):
+        query = "SELECT id, name, comment FROM comments WHERE show = ? AND episode = ? AND id < ?"
+        params = [self.showname, self.episodefunc(), before if before is not None else 2 ** 63 - 1]
+        if name:
+            query += " AND name IN (SELECT DISTINCT name FROM comments WHERE show = ? AND episode = ? AND name LIKE ? ESCAPE '\\')"
+            params += [params[0], params[1], "%%%s%%" % name.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")]
+        words = comment_words(text) if text else set()
+        if words:
+            query += " AND id IN (SELECT rowid FROM comments_fts WHERE comments_fts MATCH ?)"
+            params.append(" ".join('"%s"' % word for word in sorted(words)))
+        rows = self.db.connect().execute(query + " ORDER BY id DESC LIMIT ?", params + [limit + 1]).fetchall()
+        page = {str(commentid): {'name': commentname, 'comment': comment} for commentid, commentname, comment in rows[:limit]}
+        return page, (rows[limit - 1][0] if len(rows) > limit else None)
+
+    # returns (etag, EncodedBody) holding the current episode's comments as JSON, with the full set's body cached until the next change
+    def get_comments_body(self, since=None):
+        signature = self.get_signature(self.db.connect(), self.episodefunc())
+        etag = "%s-%s-%d" % (signature[0], signature[1], signature[2])
+        if since is not None:
+            return etag, EncodedBody(json.dumps(self.get_comments(since)).encode("utf-8"), self.compressminsize)
+        cachedsignature, commentsbody = self.commentsbody
+        if cachedsignature != signature:
+            commentsbody = EncodedBody(json.dumps(self.get_comments()).encode("utf-8"), self.compressminsize)
+            self.commentsbody = (signature, commentsbody)
+        return etag, commentsbody
+
+    # notify the listener of changes made by other processes
+    def poll(self):
+        conn = self.db.connect()
+        episode = self.episodefunc()
+        with self.lock:
+            signature = self.get_signature(conn, episode)
+            if signature == self.signature:
+                return
+            self.signature = signature
+            if episode != self.episode:
+                self.episode = episode
+                self.knownids = set()
+                self.notify("clear", None)
+            ids = self.get_ids(conn, episode)
+            deleted = self.knownids - ids
+            added = ids - self.knownids
+            self.knownids = ids
+        if deleted:
+            self.notify("delete", [str(commentid) for commentid in sorted(deleted)])
+        if added:
+            for commentid, comment in self.get_comments(min(added) - 1).items():
+                if int(commentid) in added:
+                    self.notify("comment", {commentid: comment})
+
+    # the database handles durability & cleanup itself
+    def sync(self):
+        pass
+
+    def compact(self, threshold):
+        return False
+
+    # pass the current episode's comments to write(episode, comments), as (id, {name, comment}) pairs in id order, while holding off writers,
+    # then delete them if clear is set - see CommentLog.archive, though every comment here is stored with its episode, so defaultepisode is unused
+    def archive(self, write, clear=False, defaultepisode=None):
+        conn = self.db.connect()
+        episode = self.episodefunc()
+        waitstart = time.perf_counter()
+        with self.lock:
+            # take the write lock up front, so no comment can be added between reading & deleting
+            self.begin_write(conn, waitstart)
+            try:
+                rows = conn.execute("SELECT id, name, comment FROM comments WHERE show = ? AND episode = ? ORDER BY id", (self.showname, episode))
+                first = rows.fetchone()
+                if first is not None:
+                    write(episode, ((str(commentid), {'name': name, 'comment': comment}) for commentid, name, comment in itertools.chain([first], rows)))
+                if clear:
+                    conn.execute("DELETE FROM comments WHERE show = ? AND episode = ?", (self.showname, episode))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            if clear:
+                self.knownids = set()
+        if clear:
+            self.notify("clear", None)
+
+    # delete all of the show's comments
+    def clear(self):
+        self.db.connect().execute("DELETE FROM comments WHERE show = ?", (self.showname,))
+        with self.lock:
+            self.knownids = set()
+        self.notify("clear", None)
+
+    def close(self):
+        pass
@@ -0,0 +1,441 @@
+# --------------------------------------------------------------------
+#   commentlog.py - append-only comment storage for a single show
+# --------------------------------------------------------------------
+
+import bisect
+import html
+import json
+import os
+import re
+import time
+from threading import Lock
+
+from .encoding import EncodedBody
+from .durable import write_file
+
+WORD_PATTERN = re.compile(r"\w+")
+TAG_PATTERN = re.compile(r"<[^>]*>")
+
+# lowercased set of the words in a comment, ignoring any HTML tags (such as parsed links) in it
+# used both to index comments and to split up search text, so the two always agree
+def comment_words(text):
+    return set(WORD_PATTERN.findall(html.unescape(TAG_PATTERN.sub(" ", text)).lower()))
+
+# each show's comments are stored in a log file holding one JSON record per line:
+#   {"op": "meta", "nextid": 1, "tag": "...", "epoch": 0}      written at the top of each new or compacted log
+#   {"op": "add", "id": 3, "name": "...", "comment": "...", "episode": "YYYY-MM-DD"}   new comment, and the episode it was posted in
+#   {"op": "del", "ids": [3, 5]}                                tombstone for one or more deleted comments
+# the live comment set and id counter are kept in memory, and rebuilt by replaying the log when it's opened,
+# so adding or deleting a comment only costs a single small append
+class CommentLog:
+    def __init__(self, path, maxcomments, fsync="always", fsyncinterval=1.0, lock=None, shared=False, listener=None, observer=None, compressminsize=0, durability="full", episodefunc=None, readlock=None):
+        self.path = path
+        self.maxcomments = maxcomments
+        # "always" - fsync after every record, "interval" - at most every fsyncinterval seconds, "never" - leave it to the OS
+        self.fsync = fsync
+        self.fsyncinterval = fsyncinterval
+        # durability level of compacted logs, see durable.write_file
+        self.durability = durability
+        # serializes access to the log - must be an inter-process lock if other processes write to the same log
+        self.lock = lock if lock is not None else Lock()
+        # taken instead of lock to read the comments - a shared inter-process lock lets processes read at the same time,
+        # while still keeping them out while another process writes
+        self.readlock = readlock if readlock is not None else self.lock
+        # whether other processes append to the log, in which case their records are read in before every operation
+        self.shared = shared
+        # called as listener(event, data) for every change, including ones read in from other processes:
+        # ("comment", {id: {name, comment}}), ("delete", [id...]) or ("clear", None)
+        self.listener = listener
+        # called as observer(operation, bytes, seconds) after every "read" from or "write" to the log file
+        self.observer = observer
+        # bodies returned by get_comments_body are sent compressed once they're this many bytes or more
+        self.compressminsize = compressminsize
+        # returns the current episode, as a YYYY-MM-DD string, recorded with each new comment so that a log kept across
+        # several airings of a show can be archived by episode - comments are recorded without one if this isn't given
+        self.episodefunc = episodefunc
+        self.logfile = None
+        self.lastfsync = 0
+        self.unsynced = False
+        with self.lock:
+            self.replay()
+
+    # reset in-memory state to an empty log
+    def reset(self):
+        self.comments = {}
+        # id -> episode, for live comments recorded with one
+        self.episodes = {}
+        self.nextid = 1
+        # indexes used to page through and search comments without scanning all of them:
+        # sorted list of live ids, lowercased name -> sorted ids, and word -> set of ids
+        self.ids = []
+        self.nameids = {}
+        self.wordids = {}
+        # number of log records no longer contributing to the live comment set
+        self.deadrecords = 0
+        # inode of the log file, and number of bytes of it read or written so far
+        self.inode = None
+        self.offset = 0
+        # random tag identifying this incarnation of the log, written in its meta record, and the number of times it's
+        # been compacted - ETags are built from the tag, epoch & offset, so they're the same in every process and never repeat
+        # across clears, nor across compactions, which can bring the offset back to a value it's had before
+        self.tag = os.urandom(4).hex()
+        self.epoch = 0
+        # serialized (and compressed) form of the full comment set, rebuilt lazily after each change
+        self.commentsbody = None
+
+    # rebuild in-memory state from the log file
+    def replay(self):
+        self.reset()
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, mode="rb") as logfile:
+            self.inode = os.fstat(logfile.fileno()).st_ino
+            self.read_records(logfile, False)
+
+    # apply records from the current offset to the end of an open log file, truncating a partially written final record
+    def read_records(self, logfile, notify):
+        start = time.perf_counter()
+        startoffset = self.offset
+        logfile.seek(self.offset)
+        for line in logfile:
+            # last record was cut off mid-write
+            if not line.endswith(b"\n"):
+                break
+            self.offset += len(line)
+            try:
+                self.apply(json.loads(line), notify)
+            except (ValueError, KeyError, TypeError):
+                self.deadrecords += 1
+        if self.offset < os.fstat(logfile.fileno()).st_size:
+            with open(self.path, mode="r+b") as truncatefile:
+                truncatefile.truncate(self.offset)
+        if self.observer is not None:
+            self.observer("read", self.offset - startoffset, time.perf_counter() - start)
+
+    # apply a single log record to the in-memory state, notifying the listener if asked to
+    def apply(self, record, notify=True):
+        self.commentsbody = None
+        if record['op'] == "add":
+            comment = {
+                'name'      : record['name'],
+                'comment'   : record['comment']
+            }
+            if str(record['id']) not in self.comments:
+                self.index_comment(record['id'], comment)
+            self.comments[str(record['id'])] = comment
+            if 'episode' in record:
+                self.episodes[str(record['id'])] = record['episode']
+            self.nextid = max(self.nextid, record['id'] + 1)
+            if notify:
+                self.notify("comment", {str(record['id']): comment})
+        elif record['op'] == "del":
+            # logs written before bulk deletion have a single id per tombstone
+            commentids = [str(commentid) for commentid in record['ids']] if 'ids' in record else [str(record['id'])]
+            # the tombstone and the original add records are now dead
+            self.deadrecords += 1
+            for commentid in commentids:
+                comment = self.comments.pop(commentid, None)
+                self.episodes.pop(commentid, None)
+                if comment is not None:
+                    self.unindex_comment(int(commentid), comment)
+                    self.deadrecords += 1
+            if notify:
+                self.notify("delete", commentids)
+        elif record['op'] == "meta":
+            self.nextid = max(self.nextid, record['nextid'])
+            self.tag = record.get('tag', self.tag)
+            self.epoch = record.get('epoch', 0)
+
+    def index_comment(self, commentid, comment):
+        bisect.insort(self.ids, commentid)
+        bisect.insort(self.nameids.setdefault(comment['name'].lower(), []), commentid)
+        for word in comment_words(comment['comment']):
+            self.wordids.setdefault(word, set()).add(commentid)
+
+    def unindex_comment(self, commentid, comment):
+        del self.ids[bisect.bisect_left(self.ids, commentid)]
+        nameids = self.nameids[comment['name'].lower()]
+        nameids.remove(commentid)
+        if not nameids:
+            del self.nameids[comment['name'].lower()]
+        for word in comment_words(comment['comment']):
+            self.wordids[word].discard(commentid)
+            if not self.wordids[word]:
+                del self.wordids[word]
+
+    def notify(self, event, data):
+        if self.listener is not None:
+            self.listener(event, data)
+
+    # read in changes other processes have made to a shared log since this one last looked at it
+    def catch_up(self):
+        if not self.shared:
+            return
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            # cleared by another process
+            if self.inode is not None:
+                self.close_logfile()
+                self.reset()
+                self.notify("clear", None)
+            return
+
+        if stat.st_ino != self.inode:
+            # log was compacted, or cleared & started over, by another process - replay it and report the difference
+            self.close_logfile()
+            oldcomments = self.comments
+            oldtag = self.tag
+            self.replay()
+            if self.tag != oldtag:
+                if oldcomments:
+                    self.notify("clear", None)
+                oldcomments = {}
+            deleted = [commentid for commentid in oldcomments if commentid not in self.comments]
+            if deleted:
+                self.notify("delete", deleted)
+            for commentid, comment in self.comments.items():
+                if commentid not in oldcomments:
+                    self.notify("comment", {commentid: comment})
+        elif stat.st_size > self.offset:
+            with open(self.path, mode="rb") as logfile:
+                self.read_records(logfile, True)
+
+    # append records to the log in a single write, honoring the configured fsync policy
+    def write(self, *records):
+        start = time.perf_counter()
+        startoffset = self.offset
+        if self.logfile is None:
+            self.logfile = open(self.path, mode="ab")
+            self.inode = os.fstat(self.logfile.fileno()).st_ino
+            # brand new log, start it off with its tag
+            if self.offset == 0:
+                self.append({'op': "meta", 'nextid': self.nextid, 'tag': self.tag, 'epoch': self.epoch})
+        for record in records:
+            self.append(record)
+        self.logfile.flush()
+        self.unsynced = True
+        if self.fsync == "always" or (self.fsync == "interval" and time.time() - self.lastfsync >= self.fsyncinterval):
+            self.fsync_logfile()
+        if self.observer is not None:
+            self.observer("write", self.offset - startoffset, time.perf_counter() - start)
+
+    def append(self, record):
+        data = (json.dumps(record) + "\n").encode("utf-8")
+        self.logfile.write(data)
+        self.offset += len(data)
+
+    def fsync_logfile(self):
+        os.fsync(self.logfile.fileno())
+        self.lastfsync = time.time()
+        self.unsynced = False
+
+    # add a new comment, returning its id, or None if the comment section is full
+    def add(self, name, comment):
+        return self.add_many([(name, comment)])[0]
+
+    # add a batch of new comments from a list of (name, comment) in a single write, with ids assigned in order
+    # returns the list of their ids, with None for each comment that didn't fit in the comment section
+    def add_many(self, comments):
+        with self.lock:
+            self.catch_up()
+            commentids = []
+            records = []
+            nextid = self.nextid
+            episode = self.episodefunc() if self.episodefunc is not None else None
+            for name, comment in comments:
+                if len(self.comments) + len(records) >= self.maxcomments:
+                    commentids.append(None)
+                    continue
+                records.append({'op': "add", 'id': nextid, 'name': name, 'comment': comment})
+                if episode is not None:
+                    records[-1]['episode'] = episode
+                commentids.append(str(nextid))
+                nextid += 1
+            if records:
+                self.write(*records)
+                for record in records:
+                    self.apply(record)
+            return commentids
+
+    # add a set of existing comments in {id: {name, comment}} form, used to import old JSON comment files
+    def import_comments(self, comments):
+        with self.lock:
+            self.catch_up()
+            records = [{'op': "add", 'id': int(commentid), 'name': comments[commentid]['name'], 'comment': comments[commentid]['comment']}
+                for commentid in sorted(comments.keys(), key=int)]
+            if records:
+                self.write(*records)
+                for record in records:
+                    self.apply(record)
+
+    # delete the comment with the given id, returns whether it existed
+    def delete(self, commentid):
+        return len(self.delete_many([commentid])) > 0
+
+    # delete all comments with the given ids in a single tombstone record
+    # returns the deleted comments, in {id: {name, comment}} form - ids that don't exist are ignored
+    def delete_many(self, commentids):
+        with self.lock:
+            self.catch_up()
+            return self.delete_comments(commentids)
+
+    def delete_comments(self, commentids):
+        deleted = {commentid: self.comments[commentid] for commentid in commentids if commentid in self.comments}
+        if deleted:
+            record = {'op': "del", 'ids': [int(commentid) for commentid in deleted]}
+            self.write(record)
+            self.apply(record)
+        return deleted
+
+    # number of live comments
+    def count(self):
+        with self.readlock:
+            self.catch_up()
+            return len(self.comments)
+
+    # returns a copy of the live comments, in {id: {name, comment}} form
+    # if since is given, only comments with a greater id are returned
+    def get_comments(self, since=None):
+        with self.readlock:
+            self.catch_up()
+            return self.filter_comments(since)
+
+    def filter_comments(self, since):
+        if since is None:
+            return dict(self.comments)
+        # ids are assigned in increasing order, so walk back from the newest comment
+        newcomments = []
+        for commentid in reversed(self.comments):
+            if int(commentid) <= since:
+                break
+            newcomments.append((commentid, self.comments[commentid]))
+        return dict(reversed(newcomments))
+
+    # returns (page, next cursor): the newest limit comments with ids below before, newest first, in {id: {name, comment}} form,
+    # and the before value for the following page, or None if there isn't one
+    # name matches a case-insensitive substring of the commenter's name, text matches comments containing all of its words
+    def page_comments(self, before=None, limit=50, name=None, text=None):
+        with self.readlock:
+            self.catch_up()
+            ids = self.ids
+            matches = None
+            if name:
+                # there are far fewer distinct names than comments, so check each name rather than each comment
+                matches = set()
+                for commentname, nameids in self.nameids.items():
+                    if name.lower() in commentname:
+                        matches.update(nameids)
+            if text:
+                for word in comment_words(text):
+                    wordids = self.wordids.get(word, set())
+                    matches = set(wordids) if matches is None else matches & wordids
+            if matches is not None:
+                ids = sorted(matches)
+            end = bisect.bisect_left(ids, before) if before is not None else len(ids)
+            start = max(0, end - limit)
+            page = {str(commentid): self.comments[str(commentid)] for commentid in reversed(ids[start:end])}
+            return page, (ids[start] if start > 0 else None)
+
+    # returns (etag, EncodedBody) holding the live comments as JSON, with the full set's body cached until the next change
+    def get_comments_body(self, since=None):
+        with self.readlock:
+            self.catch_up()
+            etag = "%s-%d-%d" % (self.tag, self.epoch, self.offset)
+            if since is not None:
+                return etag, EncodedBody(json.dumps(self.filter_comments(since)).encode("utf-8"), self.compressminsize)
+            if self.commentsbody is None:
+                self.commentsbody = EncodedBody(json.dumps(self.comments).encode("utf-8"), self.compressminsize)
+            return etag, self.commentsbody
+
+    # read in changes made by other processes, notifying the listener of them
+    def poll(self):
+        with self.readlock:
+            self.catch_up()
+
+    # fsync any records written since the last fsync (used with the "interval" policy)
+    def sync(self):
+        with self.lock:
+            if self.logfile is not None and self.unsynced:
+                self.fsync_logfile()
+
+    # rewrite the log with only live records once enough dead ones have built up, returns whether it compacted
+    def compact(self, threshold):
+        with self.lock:
+            self.catch_up()
+            if self.deadrecords < threshold or not os.path.exists(self.path):
+                return False
+            self.epoch += 1
+            records = [{'op': "meta", 'nextid': self.nextid, 'tag': self.tag, 'epoch': self.epoch}]
+            for commentid, comment in self.comments.items():
+                records.append({'op': "add", 'id': int(commentid), 'name': comment['name'], 'comment': comment['comment']})
+                if commentid in self.episodes:
+                    records[-1]['episode'] = self.episodes[commentid]
+            self.close_logfile()
+            stat = write_file(self.path, ((json.dumps(record) + "\n").encode("utf-8") for record in records), self.durability)
+            self.inode = stat.st_ino
+            self.offset = stat.st_size
+            self.deadrecords = 0
+            self.commentsbody = None
+            return True
+
+    # pass the live comments to write(episode, comments), as (id, {name, comment}) pairs in id order, once for each episode
+    # they were posted in - comments recorded without an episode are passed under defaultepisode
+    # the comments are copied under the lock, and written out after it's released, so writers are only held off for the copy
+    # then if clear is set, the archived comments are dropped, leaving any posted in the meantime for the next archive
+    def archive(self, write, clear=False, defaultepisode=None):
+        self.archive_comments(write, clear, defaultepisode)
+
+    # archive & delete the comments from episodes before the given one, returns the number deleted - like archive,
+    # each episode's comments are passed to write(episode, comments), unless write is None, and only deleted once it returns
+    # so a log kept across several airings of a show only ever holds the airings still within their retention
+    def archive_episodes(self, before, write=None, defaultepisode=None):
+        return self.archive_comments(write, True, defaultepisode, before)
+
+    def archive_comments(self, write, clear, defaultepisode, before=None):
+        with self.lock:
+            self.catch_up()
+            episodes = {}
+            for commentid, comment in self.comments.items():
+                episode = self.episodes.get(commentid, defaultepisode)
+                if before is None or episode < before:
+                    episodes.setdefault(episode, []).append((commentid, comment))
+            tag = self.tag
+        if write is not None:
+            for episode, comments in episodes.items():
+                write(episode, comments)
+        if not clear:
+            return 0
+        archived = [commentid for comments in episodes.values() for commentid, _ in comments]
+        with self.lock:
+            self.catch_up()
+            if self.tag != tag:
+                # cleared & started over since the copy was taken, so the archived comments are already gone
+                return 0
+            if all(commentid in self.comments for commentid in archived) and len(self.comments) == len(archived):
+                self.remove_log()
+                return len(archived)
+            return len(self.delete_comments(archived))
+
+    # drop all comments and remove the log file
+    def clear(self):
+        with self.lock:
+            self.remove_log()
+
+    def remove_log(self):
+        self.close_logfile()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.reset()
+        self.notify("clear", None)
+
+    def close_logfile(self):
+        if self.logfile is not None:
+            if self.unsynced:
+                self.fsync_logfile()
+            self.logfile.close()
+            self.logfile = None
+
+    def close(self):
+        with self.lock:
+            self.close_logfile()
@@ -0,0 +1,95 @@
+# --------------------------------------------------------------------
+#   durable.py - crash-safe file rewrites
+# --------------------------------------------------------------------
+
+import json
+import logging
+import os
+import threading
+
+# how hard write_file works to get a new file onto the disk:
+#   "full" - fsync the file, then its directory once it's renamed into place, so the new contents survive a power loss
+#   "file" - fsync the file only, so a power loss can undo the rename, but never leave a partial file behind
+#   "none" - leave flushing to the operating system, which still protects against the server itself crashing
+DURABILITY_LEVELS = ("full", "file", "none")
+
+# path of the previous generation of a file kept by write_file
+def previous_path(path):
+    return "%s.prev" % path
+
+# replace a file with the given chunks of bytes, written to a temporary file that's renamed over it,
+# so readers in any process see either the old or the new file in full, never a partial one
+# with keepprevious, the file being replaced is kept as its previous generation for read_json to fall back on
+# mode sets the new file's permissions before it's renamed into place, so it's never readable more widely
+# returns the os.stat_result of the new file
+def write_file(path, chunks, durability="full", keepprevious=False, mode=None):
+    if durability not in DURABILITY_LEVELS:
+        raise ValueError("Unknown durability level %s" % durability)
+    temppath = "%s.%s.tmp" % (path, get_writer_id())
+    try:
+        with open(temppath, mode="wb") as tempfile:
+            if mode is not None:
+                os.fchmod(tempfile.fileno(), mode)
+            for chunk in chunks:
+                tempfile.write(chunk)
+            tempfile.flush()
+            if durability != "none":
+                os.fsync(tempfile.fileno())
+            stat = os.fstat(tempfile.fileno())
+        if keepprevious and os.path.exists(path):
+            keep_previous(path)
+        os.replace(temppath, path)
+    except BaseException:
+        if os.path.exists(temppath):
+            os.remove(temppath)
+        raise
+    if durability == "full":
+        fsync_directory(os.path.dirname(os.path.abspath(path)))
+    return stat
+
+# serialize an object as JSON and write it with write_file
+def write_json(path, obj, durability="full", keepprevious=False, mode=None):
+    return write_file(path, [json.dumps(obj).encode("utf-8")], durability, keepprevious, mode)
+
+# hard link the current file as its previous generation, which costs no copying
+def keep_previous(path):
+    linkpath = "%s.%s.prevtmp" % (path, get_writer_id())
+    if os.path.exists(linkpath):
+        os.remove(linkpath)
+    try:
+        os.link(path, linkpath)
+    except FileNotFoundError:
+        # another writer renamed its new file over this one mid-link, and keeps the generation it replaced itself
+        return
+    os.replace(linkpath, previous_path(path))
+    # renaming a link over another link to the same file does nothing, which happens when a racing writer has just kept it
+    if os.path.exists(linkpath):
+        os.remove(linkpath)
+
+# tells apart temporary files of every thread in every process, so writers racing on one path never share one
+def get_writer_id():
+    return "%d-%d" % (os.getpid(), threading.get_ident())
+
+def fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# load JSON from a file, falling back to its previous generation if the file can't be parsed, or validate(obj) is false
+# returns None if the file doesn't exist, or neither generation is usable
+def read_json(path, validate=None):
+    if not os.path.exists(path):
+        return None
+    for candidate in (path, previous_path(path)):
+        try:
+            with open(candidate) as file:
+                obj = json.load(file)
+        except (FileNotFoundError, ValueError):
+            continue
+        if validate is None or validate(obj):
+            if candidate != path:
+                logging.warning("Recovered %s from its previous generation" % path)
+            return obj
+    return None
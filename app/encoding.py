@@ -0,0 +1,59 @@
+# --------------------------------------------------------------------
+#   encoding.py - pre-serialized, pre-compressed response bodies
+# --------------------------------------------------------------------
+
+import gzip
+from threading import Lock
+
+# brotli is optional - without it, clients asking for br get gzip instead
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# content encodings, in order of preference
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+# a serialized body in each content encoding, each compressed at most once, on first request
+# bodies under minsize bytes are always sent as they are, since compressing them gains little or nothing
+class EncodedBody:
+    def __init__(self, data, minsize=0, gziplevel=6, brotliquality=5):
+        self.minsize = minsize
+        self.gziplevel = gziplevel
+        self.brotliquality = brotliquality
+        self.lock = Lock()
+        # content encoding ("identity", "gzip" or "br") -> bytes
+        self.encoded = {'identity': data}
+
+    @property
+    def data(self):
+        return self.encoded['identity']
+
+    # best content encoding ("identity", "gzip" or "br") for a client, given its Accept-Encoding header as a werkzeug Accept object
+    def choose(self, acceptencodings):
+        if len(self.data) < self.minsize:
+            return "identity"
+        for encoding in ENCODINGS:
+            if acceptencodings.quality(encoding) > 0:
+                return encoding
+        return "identity"
+
+    # the body in the given content encoding
+    def get(self, encoding):
+        encoded = self.encoded.get(encoding)
+        if encoded is None:
+            with self.lock:
+                encoded = self.encoded.get(encoding)
+                if encoded is None:
+                    encoded = self.encoded[encoding] = compress(self.data, encoding, self.gziplevel, self.brotliquality)
+        return encoded
+
+# ETag for a body in the given content encoding - each encoding is a different representation, so it gets its own tag
+def encoded_etag(etag, encoding):
+    return etag if encoding == "identity" else "%s-%s" % (etag, encoding)
+
+def compress(data, encoding, gziplevel, brotliquality):
+    if encoding == "br":
+        return brotli.compress(data, quality=brotliquality)
+    # no timestamp in the header, so the same body always compresses to the same bytes
+    return gzip.compress(data, compresslevel=gziplevel, mtime=0)
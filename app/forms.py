@@ -1,5 +1,5 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, BooleanField, SelectField, PasswordField, RadioField
+from wtforms import StringField, BooleanField, SelectField, PasswordField, RadioField, SelectMultipleField
 from wtforms.validators import DataRequired
 
 class LoginForm(FlaskForm):
@@ -12,15 +12,11 @@ class AdminForm(FlaskForm):
     comments = RadioField("comments", choices=[("enabled",) * 2, ("disabled",) * 2], validators=[DataRequired()])
 
 
-def edit_comment_form_builder(comments):
-    class EditCommentForm(EditCommentFormBase):
+# multi-value field holding the ids of checked comments, rendered by hand in editcomments.html
+# choices aren't checked, since ids of comments that no longer exist are simply ignored when deleting
+class CommentIdsField(SelectMultipleField):
+    def pre_validate(self, form):
         pass
 
-    if comments:
-        for commentid in comments.keys():
-            setattr(EditCommentForm, "comment_%s" % commentid, BooleanField(label="%s:%s" % (comments[commentid]['name'], comments[commentid]['comment'])))
-
-    return EditCommentForm()
-
-class EditCommentFormBase(FlaskForm):
-    pass
+class EditCommentForm(FlaskForm):
+    delete = CommentIdsField("delete", choices=[])
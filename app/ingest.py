@@ -0,0 +1,110 @@
+# --------------------------------------------------------------------
+#   ingest.py - group commit of submitted comments
+# --------------------------------------------------------------------
+
+import logging
+import queue
+import sys
+import time
+from concurrent.futures import Future
+from threading import Lock, Thread
+
+# queue of submitted comments, drained by a single writer thread that commits them to their comment stores in batches
+# a batch closes once it holds batchsize comments, or batchwait seconds after its first comment arrived,
+# and each store gets one add_many call - so one write & fsync - per batch
+# submitters wait on a future that resolves once their comment's batch is committed, so durability is unchanged
+class IngestQueue:
+    def __init__(self, batchsize, batchwait):
+        self.batchsize = batchsize
+        self.batchwait = batchwait
+        # (comment store, name, comment, future), or None to stop the writer
+        self.queue = queue.Queue()
+        self.thread = None
+        # once stopped, submissions are turned away, since nothing would ever commit them
+        self.stopped = False
+        self.submitlock = Lock()
+        self.metricslock = Lock()
+        self.batches = 0
+        self.committed = 0
+        self.lastbatch = 0
+        self.largestbatch = 0
+
+    def start(self):
+        self.stopped = False
+        self.thread = Thread(target=self.run, name="ingest", daemon=True)
+        self.thread.start()
+
+    # commit everything already submitted, then stop the writer
+    def stop(self):
+        with self.submitlock:
+            self.stopped = True
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    # queue a comment for the given store, returns a future resolving to its id, or None if the comment section is full
+    # a submitter that gives up waiting can cancel the future, and the comment is dropped if the writer hasn't got to it yet
+    # raises RuntimeError once the queue is stopped
+    def submit(self, commentlog, name, comment):
+        future = Future()
+        with self.submitlock:
+            if self.stopped:
+                raise RuntimeError("ingest queue is stopped")
+            self.queue.put((commentlog, name, comment, future))
+        return future
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            if batch[0] is None:
+                break
+            deadline = time.monotonic() + self.batchwait
+            while len(batch) < self.batchsize:
+                try:
+                    item = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self.commit(batch)
+
+    def commit(self, batch):
+        # skip comments whose submitters have given up on them, and keep the rest from being cancelled from here on
+        batch = [item for item in batch if item[3].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        # group by store, keeping submission order within each
+        stores = {}
+        for item in batch:
+            stores.setdefault(id(item[0]), []).append(item)
+        for items in stores.values():
+            try:
+                commentids = items[0][0].add_many([(name, comment) for _, name, comment, _ in items])
+                for (_, _, _, future), commentid in zip(items, commentids):
+                    future.set_result(commentid)
+            except Exception as err:
+                _, _, exc_tb = sys.exc_info()
+                logging.error("Error committing comment batch to %s: %s: %s at line %d" % (items[0][0].path, err.__class__.__name__, str(err), exc_tb.tb_lineno))
+                for _, _, _, future in items:
+                    future.set_exception(err)
+        with self.metricslock:
+            self.batches += 1
+            self.committed += len(batch)
+            self.lastbatch = len(batch)
+            self.largestbatch = max(self.largestbatch, len(batch))
+
+    # returns {depth, batches, committed, lastbatch, largestbatch, averagebatch}
+    def get_metrics(self):
+        with self.metricslock:
+            return {
+                'depth'         : self.queue.qsize(),
+                'batches'       : self.batches,
+                'committed'     : self.committed,
+                'lastbatch'     : self.lastbatch,
+                'largestbatch'  : self.largestbatch,
+                'averagebatch'  : self.committed / self.batches if self.batches else 0
+            }
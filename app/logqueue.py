@@ -0,0 +1,107 @@
+# --------------------------------------------------------------------
+#   logqueue.py - logging off the request path
+# --------------------------------------------------------------------
+
+import json
+import logging
+import queue
+import time
+from logging.handlers import QueueHandler, QueueListener
+from threading import Lock
+
+# fields a record can carry into structured output, passed to logging calls as extra={...}
+#   event   - kind of high-frequency message, rate limited by EventRateFilter
+#   route, method, status, seconds, outcome - request records logged by views.py
+RECORD_FIELDS = ("event", "route", "method", "status", "seconds", "outcome", "suppressed")
+
+LOG_FORMAT = "%(asctime)s %(levelname)-8s %(message)s"
+LOG_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# set up the root logger to write to filename, returns the QueueListener writing records, or None when logging synchronously
+# with queuesize > 0, callers only put records on a queue holding up to queuesize of them, and a background thread
+# writes them out, so a slow disk never holds up a request - records arriving while the queue is full are dropped & counted
+# records tagged with an event are let through at most eventlimit times per eventinterval seconds for each event
+def configure_logging(filename, structured=False, queuesize=0, eventlimit=0, eventinterval=60):
+    filehandler = logging.FileHandler(filename)
+    filehandler.setFormatter(JSONFormatter(datefmt=LOG_DATE_FORMAT) if structured else logging.Formatter(LOG_FORMAT, LOG_DATE_FORMAT))
+
+    rootlogger = logging.getLogger()
+    rootlogger.setLevel(logging.INFO)
+    if queuesize <= 0:
+        handler = filehandler
+        listener = None
+    else:
+        handler = DroppingQueueHandler(queue.Queue(queuesize))
+        listener = QueueListener(handler.queue, filehandler, respect_handler_level=True)
+        listener.start()
+    # filtered before queueing, so held back records cost nothing more
+    if eventlimit > 0:
+        handler.addFilter(EventRateFilter(eventlimit, eventinterval))
+    rootlogger.addHandler(handler)
+    return listener
+
+# QueueHandler that never blocks - with the queue full, records are dropped, and the count is logged once there's room again
+# enqueue runs under the handler's own lock, taken by Handler.handle, which also guards the dropped count
+class DroppingQueueHandler(QueueHandler):
+    def __init__(self, logqueue):
+        super().__init__(logqueue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self.dropped:
+            notice = logging.makeLogRecord({'name': record.name, 'levelno': logging.WARNING, 'levelname': "WARNING",
+                'msg': "Dropped %d log records while the log queue was full" % self.dropped})
+            try:
+                self.queue.put_nowait(notice)
+                self.dropped = 0
+            except queue.Full:
+                pass
+
+# lets records tagged with extra={'event': ...} through at most limit times per interval seconds for each event,
+# so a flood of the same message can't flood the log - untagged records always pass
+# the first record let through in a new interval notes how many were held back in the last one
+class EventRateFilter(logging.Filter):
+    def __init__(self, limit, interval):
+        super().__init__()
+        self.limit = limit
+        self.interval = interval
+        self.lock = Lock()
+        # event -> [start of its current interval, records let through, records held back]
+        self.windows = {}
+
+    def filter(self, record):
+        event = getattr(record, "event", None)
+        if event is None:
+            return True
+        now = time.monotonic()
+        suppressed = 0
+        with self.lock:
+            window = self.windows.get(event)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window is not None else 0
+                window = self.windows[event] = [now, 0, 0]
+            if window[1] >= self.limit:
+                window[2] += 1
+                return False
+            window[1] += 1
+        if suppressed:
+            record.msg = "%s (%d similar messages suppressed)" % (record.getMessage(), suppressed)
+            record.args = None
+            record.suppressed = suppressed
+        return True
+
+# one JSON object per record, with the time, level & message, plus any RECORD_FIELDS the record carries
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'time': self.formatTime(record, self.datefmt), 'level': record.levelname, 'message': record.getMessage()}
+        for field in RECORD_FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
@@ -0,0 +1,185 @@
+# --------------------------------------------------------------------
+#   metrics.py - counters & histograms in Prometheus text format
+# --------------------------------------------------------------------
+
+import logging
+import math
+import time
+from threading import Lock
+
+# latency buckets, in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# size buckets, in bytes
+BYTE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+def format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+        for name, value in pairs)
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+# monotonically increasing count, optionally split up by labels
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.lock = Lock()
+        self.values = {}
+
+    def inc(self, *labelvalues, amount=1):
+        with self.lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s counter" % self.name]
+        with self.lock:
+            for labelvalues, value in sorted(self.values.items()):
+                lines.append("%s%s %s" % (self.name, format_labels(self.labelnames, labelvalues), format_value(value)))
+        return lines
+
+# distribution of observed values over fixed buckets, optionally split up by labels
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets) + (math.inf,)
+        self.lock = Lock()
+        # labels -> [count per bucket..., sum]
+        self.values = {}
+
+    def observe(self, value, *labelvalues):
+        with self.lock:
+            counts = self.values.get(labelvalues)
+            if counts is None:
+                counts = self.values[labelvalues] = [0] * len(self.buckets) + [0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-1] += value
+
+    # context manager observing the time spent inside it
+    def time(self, *labelvalues):
+        return Timer(self, labelvalues)
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+        with self.lock:
+            for labelvalues, counts in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    lines.append("%s_bucket%s %d" % (self.name, format_labels(self.labelnames, labelvalues, [("le", format_value(bound))]), cumulative))
+                lines.append("%s_sum%s %s" % (self.name, format_labels(self.labelnames, labelvalues), format_value(counts[-1])))
+                lines.append("%s_count%s %d" % (self.name, format_labels(self.labelnames, labelvalues), cumulative))
+        return lines
+
+class Timer:
+    def __init__(self, histogram, labelvalues):
+        self.histogram = histogram
+        self.labelvalues = labelvalues
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labelvalues)
+
+# values read from func when scraped, which returns {(labelvalues...): value}
+# kind is "gauge", or "counter" for totals kept elsewhere
+class Gauge:
+    def __init__(self, name, help, labelnames, func, kind="gauge"):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.func = func
+        self.kind = kind
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.kind)]
+        for labelvalues, value in sorted(self.func().items()):
+            lines.append("%s%s %s" % (self.name, format_labels(self.labelnames, labelvalues), format_value(value)))
+        return lines
+
+# stands in for every metric while metrics are turned off, so instrumented code costs a no-op call
+class NullMetric:
+    def inc(self, *labelvalues, amount=1):
+        pass
+
+    def observe(self, value, *labelvalues):
+        pass
+
+    def time(self, *labelvalues):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+NULL_METRIC = NullMetric()
+
+# every metric of the server, rendered together for /metrics
+class MetricsRegistry:
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.metrics = []
+
+    def register(self, metric):
+        if not self.enabled:
+            return NULL_METRIC
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name, help, labelnames, func, kind="gauge"):
+        return self.register(Gauge(name, help, labelnames, func, kind))
+
+    # all metrics in the Prometheus text exposition format
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+# logging handler counting records by level
+class LogCounter(logging.Handler):
+    def __init__(self, counter, level=logging.WARNING):
+        super().__init__(level)
+        self.counter = counter
+
+    def emit(self, record):
+        self.counter.inc(record.levelname)
+
+# lock recording how long each acquisition waited for it, under the given label values
+# wraps any lock usable in a with statement, including an InterProcessLock
+class TimedLock:
+    def __init__(self, lock, histogram, *labelvalues):
+        self.lock = lock
+        self.histogram = histogram
+        self.labelvalues = labelvalues
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self.lock.__enter__()
+        self.histogram.observe(time.perf_counter() - start, *self.labelvalues)
+        return self
+
+    def __exit__(self, *exc):
+        return self.lock.__exit__(*exc)
@@ -0,0 +1,90 @@
+# --------------------------------------------------------------------
+#   ratelimit.py - flood protection for submitted comments
+# --------------------------------------------------------------------
+
+import hashlib
+import time
+from collections import OrderedDict, deque
+from threading import Lock
+
+# token buckets for any number of clients, in a table holding at most maxentries of them
+# each bucket holds up to burst tokens and refills at rate tokens per second, and every post takes a token
+# once the table is full the least recently seen client is evicted, and just starts over with a full bucket
+class TokenBucketTable:
+    def __init__(self, rate, burst, maxentries):
+        self.rate = rate
+        self.burst = burst
+        self.maxentries = maxentries
+        self.lock = Lock()
+        # key -> (tokens, time of last update), least recently seen first
+        self.buckets = OrderedDict()
+
+    # take a token from the key's bucket, returns whether there was one to take
+    def allow(self, key, now=None):
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.maxentries:
+                self.buckets.popitem(last=False)
+            return allowed
+
+    # give back a token taken by allow() - for limiting only some outcomes, like failed logins, where every attempt
+    # takes a token up front, so parallel attempts can't all get through, and the ones that turn out fine hand it back
+    def refund(self, key, now=None):
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            if key in self.buckets:
+                tokens, updated = self.buckets[key]
+                self.buckets[key] = (min(self.burst, tokens + (now - updated) * self.rate + 1), now)
+
+    # whether the key's bucket has a token, without taking it
+    def available(self, key, now=None):
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            if key not in self.buckets:
+                return True
+            tokens, updated = self.buckets[key]
+            return min(self.burst, tokens + (now - updated) * self.rate) >= 1
+
+# hashes of the last window comments posted to a show, used to turn away repeats of any of them
+class DuplicateFilter:
+    def __init__(self, window):
+        self.window = window
+        self.lock = Lock()
+        self.order = deque()
+        self.hashes = set()
+
+    # returns whether the comment repeats a recent one, remembering it if it doesn't
+    # comments are compared ignoring case & whitespace, and only against earlier comments under the same name
+    # it's remembered right away, so a double-posted comment is turned away while the first copy is being stored -
+    # if storing it then fails, forget() it, so it can be posted again
+    def check(self, name, comment):
+        digest = self.get_digest(name, comment)
+        with self.lock:
+            if digest in self.hashes:
+                return True
+            self.order.append(digest)
+            self.hashes.add(digest)
+            if len(self.order) > self.window:
+                self.hashes.discard(self.order.popleft())
+            return False
+
+    # drop a comment remembered by check()
+    def forget(self, name, comment):
+        digest = self.get_digest(name, comment)
+        with self.lock:
+            if digest in self.hashes:
+                self.hashes.discard(digest)
+                self.order.remove(digest)
+
+    def get_digest(self, name, comment):
+        key = "%s\0%s" % (" ".join(name.lower().split()), " ".join(comment.lower().split()))
+        return hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
@@ -0,0 +1,28 @@
+# --------------------------------------------------------------------
+#   sanitize.py - cleaning & link parsing for submitted comments
+# --------------------------------------------------------------------
+
+import html
+import re
+
+import bleach
+
+# input that simple escaping wouldn't clean the same way bleach does, so it's handed to bleach instead:
+# control characters the HTML parser rewrites, anything that could be read as a character reference, comments, doctypes & processing instructions,
+# end tags without a name, and tags holding quotes, ampersands or another tag, or left open at the end of the text
+FALLBACK_PATTERN = re.compile(r"[\x00-\x08\x0b-\x1f]|&[A-Za-z0-9#]|&[^;&]*;|<[!?]|</(?![A-Za-z])|</?[A-Za-z][^<>\"'&]*(?:[<\"'&]|\Z)")
+
+# hyperlinks, with or without a scheme, at the start of the text or after whitespace
+LINK_PATTERN = re.compile(r"(?:(?:http(?:s)?://)|^|\s)([^\s/$?.#:]*\.[^\s.][^\s]*)")
+
+# clean text exactly as bleach.clean(text, tags=[]) does, which escapes tags rather than stripping them
+# bleach builds an html5lib parse tree for every call, but for everything outside of FALLBACK_PATTERN - which covers
+# ordinary chat, including stray <, > and & characters and simple tags - its output is the same as plain escaping
+def clean(text):
+    if FALLBACK_PATTERN.search(text) is None:
+        return html.escape(text, quote=False)
+    return bleach.clean(text, tags=[])
+
+# turn hyperlinks in cleaned text into HTML, using linkformat with \1 standing for the link
+def parse_links(text, linkformat):
+    return LINK_PATTERN.sub(linkformat, text)
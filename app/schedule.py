@@ -0,0 +1,68 @@
+# --------------------------------------------------------------------
+#   schedule.py - precomputed lookups over the internal schedule
+# --------------------------------------------------------------------
+
+# read-only index over a schedule obj of the form [{hour: {show, comments}}], built once per schedule change
+# the schedule obj it's built from must not be modified afterwards - copy it with copy_schedule, change the copy,
+# and build a new index instead, so readers holding the old index always see a consistent schedule
+class ScheduleIndex:
+    def __init__(self, schedobj, generation=0):
+        self.schedobj = schedobj
+        # bumped every time a new index is published
+        self.generation = generation
+        # show name -> comment setting of its first timeslot
+        self.settings = {}
+        # show name -> [(day, hour)...] of every timeslot it occupies
+        self.slots = {}
+        # [day][hour] -> timeslot dict, or None if nothing is scheduled
+        self.slotarray = [[None] * 24 for day in range(7)]
+
+        for daynum, day in enumerate(schedobj):
+            for hour, slot in day.items():
+                self.settings.setdefault(slot['show'], slot['comments'])
+                self.slots.setdefault(slot['show'], []).append((daynum, int(hour)))
+                if daynum < 7 and 0 <= int(hour) < 24:
+                    self.slotarray[daynum][int(hour)] = slot
+
+        # all unique shows, in alphabetical order
+        self.shows = sorted(self.slots.keys(), key=lambda x: x.lower())
+
+    # timeslot at the given day (0 = Sunday) and hour, or None
+    def get_slot(self, day, hour):
+        return self.slotarray[day][hour]
+
+# copy of a schedule obj whose timeslot dicts can be safely modified
+def copy_schedule(schedobj):
+    return [{hour: dict(slot) for hour, slot in day.items()} for day in schedobj]
+
+# changes needed to bring a schedule obj in line with a source schedule of the form [{hour: {show, ...}}] (hours 0-23),
+# as {(day, hour): new timeslot dict, or None to remove it} - timeslots keep their comment setting unless their show changes,
+# and newly scheduled shows get getsetting(showname)
+def diff_schedule(schedobj, inputschedobj, getsetting):
+    diff = {}
+    for day in range(7):
+        schedday = schedobj[day]
+        inputschedday = inputschedobj[day]
+        for hournum in range(24):
+            hour = str(hournum)
+            if hour in inputschedday:
+                if hour not in schedday or inputschedday[hour]['show'] != schedday[hour]['show']:
+                    diff[(day, hour)] = {
+                        'show'      : inputschedday[hour]['show'],
+                        'comments'  : getsetting(inputschedday[hour]['show'])
+                    }
+            elif hour in schedday:
+                diff[(day, hour)] = None
+    return diff
+
+# new schedule obj with a diff from diff_schedule applied, sharing the timeslot dicts of unchanged days
+def apply_schedule_diff(schedobj, diff):
+    newschedobj = list(schedobj)
+    for day in set(day for day, _ in diff):
+        newschedobj[day] = dict(schedobj[day])
+    for (day, hour), slot in diff.items():
+        if slot is None:
+            newschedobj[day].pop(hour)
+        else:
+            newschedobj[day][hour] = slot
+    return newschedobj
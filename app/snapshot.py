@@ -0,0 +1,80 @@
+# --------------------------------------------------------------------
+#   snapshot.py - static snapshots of comments for the web server to serve
+# --------------------------------------------------------------------
+
+import logging
+import os
+import sys
+import time
+from threading import Event, Thread
+
+from .durable import write_file
+
+# keeps a web root up to date with a static copy of each comment room's GET /comments body, plus a gzipped copy
+# alongside it for the web server to send to clients that accept gzip - a room with comments disabled gets "null"
+# requests are debounced: the first one after a publish waits interval seconds for others to join it, so however
+# fast comments come in, snapshots are written at most once per interval, and each file only when its contents change
+# render() returns [(filename, version, EncodedBody)...], and is called under lock, if given, so that publishers in
+# several worker processes take turns, and the last one to write always rendered the latest state
+class SnapshotPublisher:
+    def __init__(self, webroot, interval, render, lock=None, durability="none"):
+        self.webroot = webroot
+        self.interval = interval
+        self.render = render
+        self.lock = lock
+        self.durability = durability
+        self.requested = Event()
+        self.stopping = False
+        self.thread = None
+        # filename -> version last written by this process
+        self.published = {}
+
+    # starts the publisher thread, which publishes once right away
+    def start(self):
+        os.makedirs(self.webroot, exist_ok=True)
+        self.thread = Thread(target=self.run, name="snapshot", daemon=True)
+        self.thread.start()
+        self.requested.set()
+
+    # publishes anything still requested, then stops the publisher thread
+    def stop(self):
+        if self.thread is not None:
+            self.stopping = True
+            self.requested.set()
+            self.thread.join()
+            self.thread = None
+
+    # ask for the snapshots to be brought up to date - cheap enough to call on every comment
+    def request(self):
+        self.requested.set()
+
+    def run(self):
+        while not self.stopping:
+            self.requested.wait()
+            if not self.stopping:
+                # let a burst of changes build up, rather than writing for each one
+                time.sleep(self.interval)
+            # anything requested from here on wasn't necessarily rendered, so gets another publish
+            self.requested.clear()
+            self.publish()
+
+    def publish(self):
+        try:
+            if self.lock is None:
+                self.write_snapshots()
+            else:
+                with self.lock:
+                    self.write_snapshots()
+        except Exception as err:
+            _, _, exc_tb = sys.exc_info()
+            logging.error("Error publishing comment snapshots to %s: %s: %s at line %d" % (self.webroot, err.__class__.__name__, str(err), exc_tb.tb_lineno))
+
+    def write_snapshots(self):
+        for filename, version, body in self.render():
+            if self.published.get(filename) == version:
+                continue
+            path = os.path.join(self.webroot, filename)
+            # the gzipped copy goes first, so it's never older than the file it's a copy of
+            write_file("%s.gz" % path, [body.get("gzip")], self.durability)
+            write_file(path, [body.data], self.durability)
+            self.published[filename] = version
@@ -0,0 +1,161 @@
+# --------------------------------------------------------------------
+#   state.py - backends for state shared between server processes
+# --------------------------------------------------------------------
+
+import fcntl
+import hashlib
+import json
+import os
+import sqlite3
+from threading import Lock, local
+
+# both backends store JSON-serializable values under string keys, each with a version bumped on every set,
+# hand out named locks for serializing writers (and keeping readers out while they write), and decide which process
+# runs the scheduled tasks
+
+# state kept in this process only, for running a single worker
+class LocalStateBackend:
+    # whether other processes share this state
+    shared = False
+
+    def __init__(self):
+        self.lockslock = Lock()
+        self.locks = {}
+        self.values = {}
+
+    # lock serializing writers of the named resource - with shared, the lock taken by its readers, which only keeps
+    # them from running alongside writers (in one process, that's the same lock)
+    def lock(self, name, shared=False):
+        with self.lockslock:
+            return self.locks.setdefault(name, Lock())
+
+    # returns {key: version} for every stored value
+    def get_versions(self):
+        return {key: value[0] for key, value in self.values.items()}
+
+    # returns (version, value), or (0, None) if key was never set
+    def get(self, key):
+        return self.values.get(key, (0, None))
+
+    # store a value, returns its new version
+    def set(self, key, value):
+        version = self.get(key)[0] + 1
+        self.values[key] = (version, value)
+        return version
+
+    # whether this process should run the scheduled tasks
+    def elect_leader(self):
+        return True
+
+    def close(self):
+        pass
+
+# thread lock combined with an exclusive flock on a lock file, so it serializes threads across processes
+class InterProcessLock:
+    def __init__(self, path):
+        self.path = path
+        # flock is held per open file, so threads of this process have to be kept out with a regular lock
+        self.threadlock = Lock()
+        self.lockfile = None
+        # the same lock taken with a shared flock, for readers - processes reading at once don't hold each other up,
+        # though threads of one process still take turns
+        self.shared = SharedLock(self)
+
+    def __enter__(self):
+        self.acquire(fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def acquire(self, operation):
+        self.threadlock.acquire()
+        try:
+            # opened on first use, so each forked worker gets its own open file
+            if self.lockfile is None:
+                self.lockfile = open(self.path, mode="a")
+            fcntl.flock(self.lockfile.fileno(), operation)
+        except BaseException:
+            self.threadlock.release()
+            raise
+
+    def release(self):
+        fcntl.flock(self.lockfile.fileno(), fcntl.LOCK_UN)
+        self.threadlock.release()
+
+class SharedLock:
+    def __init__(self, lock):
+        self.lock = lock
+
+    def __enter__(self):
+        self.lock.acquire(fcntl.LOCK_SH)
+        return self
+
+    def __exit__(self, *exc):
+        self.lock.release()
+
+# state shared by every worker process through a SQLite database in WAL mode,
+# with lock files in a directory next to the database
+class SqliteStateBackend:
+    shared = True
+
+    def __init__(self, path):
+        self.path = path
+        self.lockdir = "%s.locks" % path
+        os.makedirs(self.lockdir, exist_ok=True)
+        self.lockslock = Lock()
+        self.locks = {}
+        self.leaderfile = None
+        # sqlite connections can't be shared between threads
+        self.connections = local()
+        with self.connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, version INTEGER NOT NULL, value TEXT NOT NULL)")
+
+    def connect(self):
+        conn = getattr(self.connections, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.connections.conn = conn
+        return conn
+
+    def lock(self, name, shared=False):
+        with self.lockslock:
+            if name not in self.locks:
+                # hash the name, since it may be a show name that isn't safe to use as a filename
+                self.locks[name] = InterProcessLock("%s/%s.lock" % (self.lockdir, hashlib.sha1(name.encode("utf-8")).hexdigest()))
+            return self.locks[name].shared if shared else self.locks[name]
+
+    def get_versions(self):
+        return dict(self.connect().execute("SELECT key, version FROM state").fetchall())
+
+    def get(self, key):
+        row = self.connect().execute("SELECT version, value FROM state WHERE key = ?", (key,)).fetchone()
+        return (row[0], json.loads(row[1])) if row else (0, None)
+
+    def set(self, key, value):
+        conn = self.connect()
+        with conn:
+            conn.execute("INSERT INTO state (key, version, value) VALUES (?, 1, ?) "
+                "ON CONFLICT(key) DO UPDATE SET version = version + 1, value = excluded.value", (key, json.dumps(value)))
+            return conn.execute("SELECT version FROM state WHERE key = ?", (key,)).fetchone()[0]
+
+    # the first process to flock the leader file holds it until it exits, at which point the next one to ask takes over
+    def elect_leader(self):
+        with self.lockslock:
+            if self.leaderfile is None:
+                leaderfile = open("%s/leader.lock" % self.lockdir, mode="a")
+                try:
+                    fcntl.flock(leaderfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    leaderfile.close()
+                    return False
+                self.leaderfile = leaderfile
+            return True
+
+    def close(self):
+        with self.lockslock:
+            if self.leaderfile is not None:
+                self.leaderfile.close()
+                self.leaderfile = None
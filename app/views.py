@@ -3,37 +3,47 @@
 import app
 from .forms import *
 from .models import User
+from . import sanitize
+from .encoding import encoded_etag
 
 import flask
 import flask_login
 
-import bleach
-
 # basic imports
 import json
 import logging
-import os
 import sys
 import datetime
-import re
+import time
+import random
+from threading import Lock
 
 # web endpoint handlers
 
 # get json comments for current show, if enabled
+# ?mount=<<MOUNTPOINT>> picks the comment room of one of COMMENT_MOUNTPOINTS, rather than MAIN_MOUNTPOINT's, here & below
+# supports If-None-Match against the returned ETag, and ?since=<id> to return only comments newer than that id
+# the body is sent pre-serialized, and compressed if the client accepts it
 @app.flaskapp.route("/comments")
 def get_comments():
     try:
-        if check_comments_enabled():
-            commentfile = app.get_comment_file()
-            # return comment file
-            if os.path.exists(commentfile):
-                with app.commentfilelock:
-                    with open(commentfile) as commentfileobj:
-                        comments = commentfileobj.read()
-                return comments
-            # return empty array
+        mount = get_request_mount()
+        if check_comments_enabled(mount):
+            since = flask.request.args.get("since", type=int)
+            etag, body = app.get_comment_log(mount=mount).get_comments_body(since)
+            encoding = body.choose(flask.request.accept_encodings)
+            etag = encoded_etag(etag, encoding)
+            # nothing has changed since the client's last fetch
+            if etag in flask.request.if_none_match:
+                response = flask.Response(status=304)
             else:
-                return json.dumps({})
+                response = flask.Response(body.get(encoding), mimetype="text/html")
+                if encoding != "identity":
+                    response.headers['Content-Encoding'] = encoding
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = app.flaskapp.config['COMMENTS_CACHE_CONTROL']
+            response.vary.add("Accept-Encoding")
+            return response
         else:
             # return None, indicating comments are disabled at this point
             return json.dumps(None)
@@ -42,65 +52,78 @@ def get_comments():
         logging.error("Error returning comments: %s: %s: %s at line %d" % (err.__class__.__name__, err.__class__.__name__, str(err), exc_tb.tb_lineno))
         return "error"
 
+# push comments for current show as server-sent events, as they're added
+# starts with a "comments" event holding the current comments (or those after ?since=<id> / Last-Event-ID),
+# then sends "comment", "delete" and "clear" events as they happen, with a heartbeat when idle
+# sends a "disabled" or "show" event and closes when comments get disabled or the show changes
+@app.flaskapp.route("/comments/stream")
+def stream_comments():
+    try:
+        since = flask.request.args.get("since", type=int)
+        if since is None and flask.request.headers.get("Last-Event-ID", "").isdigit():
+            since = int(flask.request.headers["Last-Event-ID"])
+        return flask.Response(comment_event_stream(since, get_request_mount()), mimetype="text/event-stream",
+            headers={'Cache-Control': "no-cache", 'X-Accel-Buffering': "no"})
+    except Exception as err:
+        _, _, exc_tb = sys.exc_info()
+        logging.error("Error streaming comments: %s: %s at line %d" % (err.__class__.__name__, str(err), exc_tb.tb_lineno))
+        return "error"
+
 # add new comment to the pile
 # comment should be in an HTML form, with a 'name' and 'comment' field
 @app.flaskapp.route("/new", methods=["POST"])
 def add_comment():
     try:
-        if check_comments_enabled():
+        mount = get_request_mount()
+        if check_comments_enabled(mount):
 
             if 'name' in flask.request.form and 'comment' in flask.request.form:
-                safename = bleach.clean(flask.request.form['name'], tags=[])
-                safecomment = bleach.clean(flask.request.form['comment'], tags=[])
-
-                # truncate name and comment to max length
-                if len(safename) > app.flaskapp.config['MAX_NAME_LENGTH']:
-                    safename = "%s..." % safename[:app.flaskapp.config['MAX_NAME_LENGTH']]
-                if len(safecomment) > app.flaskapp.config['MAX_COMMENT_LENGTH']:
-                    safecomment = "%s..." % safecomment[:app.flaskapp.config['MAX_COMMENT_LENGTH']]
-
-                # search for links and make them clickable
-                if app.flaskapp.config['PARSE_LINKS']:
-                    safecomment = re.sub("(?:(?:http(?:s)?://)|^|\\s)([^\\s/$?.#:]*\\.[^\\s\.][^\\s]*)", app.flaskapp.config['PARSED_LINK_FORMAT'], safecomment)
-
-                commentfile = app.get_comment_file()
-
-                # add comment to file
-                with app.commentfilelock:
-                    if os.path.exists(commentfile):
-                        commentsobj = json.load(open(commentfile))
-                        if len(commentsobj.keys()) < app.flaskapp.config['MAX_COMMENTS']:
-                            if len(commentsobj.keys()) > 0:
-                                commentid = str(max([int(key) for key in commentsobj.keys()]) + 1)
-                            else:
-                                commentid = "1"
-            
-                            commentsobj[commentid] = {
-                                'name'      : safename,
-                                'comment'   : safecomment
-                            }
-                        else:
-                            return "comment section full"
-                    else:
-                        commentsobj = {
-                            '1'   :   {
-                                'name'      : safename,
-                                'comment'   : safecomment
-                            }
-                        }
-
-                    with open(commentfile, mode="w") as commentfileobj:
-                        json.dump(commentsobj, commentfileobj)
+                # turn away floods before spending anything on sanitizing & storing them
+                if not app.check_comment_rate(flask.request.remote_addr, flask.request.form['name']):
+                    flask.g.outcome = "rate_limited"
+                    return "posting too fast"
+                if app.check_duplicate_comment(flask.request.form['name'], flask.request.form['comment'], mount):
+                    flask.g.outcome = "duplicate"
+                    return "duplicate comment"
+
+                # the comment only stays in the duplicate window once it's stored, so a post that fails may be retried
+                commentid = None
+                try:
+                    safename = sanitize.clean(flask.request.form['name'])
+                    safecomment = sanitize.clean(flask.request.form['comment'])
+
+                    # truncate name and comment to max length
+                    if len(safename) > app.flaskapp.config['MAX_NAME_LENGTH']:
+                        safename = "%s..." % safename[:app.flaskapp.config['MAX_NAME_LENGTH']]
+                    if len(safecomment) > app.flaskapp.config['MAX_COMMENT_LENGTH']:
+                        safecomment = "%s..." % safecomment[:app.flaskapp.config['MAX_COMMENT_LENGTH']]
+
+                    # search for links and make them clickable
+                    if app.flaskapp.config['PARSE_LINKS']:
+                        safecomment = sanitize.parse_links(safecomment, app.flaskapp.config['PARSED_LINK_FORMAT'])
+
+                    # append comment to current show's log, which pushes it out to stream subscribers
+                    commentid = app.store_comment(safename, safecomment, mount)
+                finally:
+                    if commentid is None:
+                        app.forget_duplicate_comment(flask.request.form['name'], flask.request.form['comment'], mount)
+                if commentid is None:
+                    flask.g.outcome = "full"
+                    return "comment section full"
+                flask.g.outcome = "added"
                 return "comment successfully added"
             else:
-                logging.info("Recieved invalid comment: %s" % ",".join(flask.request.form.keys()))
+                logging.info("Recieved invalid comment: %s" % ",".join(flask.request.form.keys()), extra={'event': "invalid_comment"})
+                flask.g.outcome = "invalid"
                 return "invalid comment"
         else:
+            flask.g.outcome = "disabled"
             return "comments currently disabled"
         
     except Exception as err:
         _, _, exc_tb = sys.exc_info()
         logging.error("Error adding comment: %s: %s at line %d" % (err.__class__.__name__, str(err), exc_tb.tb_lineno))
+        flask.g.outcome = "error"
         return "error"
             
 # handle GET and POST requests to admin console, including authentication
@@ -112,7 +135,6 @@ def login():
         form = LoginForm()
         # check for valid POST data
         if form.validate_on_submit():
-            logging.info("user %s attempting to log in" % form.username.data)
             return check_login(form.username.data, form.password.data, form.rememberme.data)
         return flask.render_template("login.html", form=form)
     except Exception as err:
@@ -125,15 +147,21 @@ def login():
 def admin():
     try:
         form = AdminForm()
-        form.show.choices = [(show, show) for show in app.get_all_shows()]
+        # shows on the schedule, plus the rooms on other mountpoints, which are set by their room name
+        rooms = dict((app.get_room_name(show, mount), (show, mount)) for show, mount in app.get_all_rooms())
+        form.show.choices = [(show, show) for show in app.get_all_shows()] + \
+            [(room, "%s (%s)" % rooms[room]) for room in sorted(rooms, key=lambda room: (rooms[room][0].lower(), rooms[room][1]))]
         if form.validate_on_submit():
             commentssetting = form.comments.data == "enabled"
-            app.set_show_comment_setting(form.show.data, commentssetting)
+            if form.show.data in rooms:
+                app.set_room_comment_setting(rooms[form.show.data][0], rooms[form.show.data][1], commentssetting)
+            else:
+                app.set_show_comment_setting(form.show.data, commentssetting)
             logging.info("user %s changed comment setting for %s" % (flask.g.user.get_id(), form.show.data))
             flask.flash("Comments %s for %s." % (form.comments.data, form.show.data))
             return flask.redirect(flask.url_for("admin"))
-        logging.info("user %s accessed admin page" % flask.g.user.get_id())
-        return flask.render_template("admin.html", form=form)
+        logging.info("user %s accessed admin page" % flask.g.user.get_id(), extra={'event': "admin_page"})
+        return flask.render_template("admin.html", form=form, mounts=sorted(app.mountstatuses))
     except Exception as err:
         _, _, exc_tb = sys.exc_info()
         logging.error("Error in admin console: %s: %s at line %d" % (err.__class__.__name__, str(err), exc_tb.tb_lineno))
@@ -143,28 +171,71 @@ def admin():
 @flask_login.login_required
 def editcomments():
     try:
-        if check_comments_enabled():
-            comments = json.loads(get_comments())
-            form = edit_comment_form_builder(comments)
+        # the main mountpoint's room, or another's with ?mount=
+        mount = get_request_mount()
+        if check_comments_enabled(mount):
+            form = EditCommentForm()
             if form.validate_on_submit():
-                commentsdeleted = False
-                commentids = list(comments.keys())
-                for commentid in commentids:
-                    if getattr(form, "comment_%s" % commentid).data:
-                        commentsdeleted = True
-                        logging.info("user %s deleted comment %s from user %s" % (flask.g.user.get_id(), comments[commentid]['comment'], comments[commentid]['name']))
-                        delete_comment(comments, commentid)
-                if commentsdeleted:
+                if delete_comments(form.delete.data, mount):
                     flask.flash("Comments deleted.")
-                return flask.redirect(flask.url_for("editcomments"))
-            return flask.render_template("editcomments.html", enabled=True, form=form, comments=comments)
+                # stay on the same page of comments
+                return flask.redirect(flask.url_for("editcomments", **flask.request.args.to_dict()))
+            # one page of comments at a time, paged with ?before=<id>&limit= and filtered with ?name= and ?text=
+            before = flask.request.args.get("before", type=int)
+            limit = flask.request.args.get("limit", app.flaskapp.config['ADMIN_COMMENTS_PAGE_SIZE'], type=int)
+            limit = min(max(limit, 1), app.flaskapp.config['MAX_COMMENTS'])
+            name = flask.request.args.get("name") or None
+            text = flask.request.args.get("text") or None
+            comments, nextbefore = app.get_comment_log(mount=mount).page_comments(before, limit, name, text)
+            return flask.render_template("editcomments.html", enabled=True, form=form, comments=comments,
+                before=before, nextbefore=nextbefore, limit=limit, name=name, text=text, mount=mount)
         else:
-            return flask.render_template("editcomments.html", enabled=False)
+            return flask.render_template("editcomments.html", enabled=False, mount=mount)
     except Exception as err:
         _, _, exc_tb = sys.exc_info()
         logging.error("Error editing comments in admin console: %s: %s at line %d" % (err.__class__.__name__, str(err), exc_tb.tb_lineno))
         return "error"
 
+# delete comments from the current show in bulk, on the main mountpoint or another with ?mount=
+# takes a JSON list of comment ids, or a JSON object with the list under "ids", and returns the ids actually deleted
+@app.flaskapp.route("/admin/comments/delete", methods=["POST"])
+@flask_login.login_required
+def bulk_delete_comments():
+    try:
+        mount = get_request_mount()
+        if app.get_mount_status(mount) is None:
+            return flask.jsonify(error="no comment room on mountpoint %s" % mount), 400
+        data = flask.request.get_json(silent=True)
+        commentids = data.get('ids') if isinstance(data, dict) else data
+        if not isinstance(commentids, list):
+            return flask.jsonify(error="expected a list of comment ids"), 400
+        deleted = delete_comments([str(commentid) for commentid in commentids], mount)
+        return flask.jsonify(deleted=list(deleted.keys()))
+    except Exception as err:
+        _, _, exc_tb = sys.exc_info()
+        logging.error("Error bulk deleting comments: %s: %s at line %d" % (err.__class__.__name__, str(err), exc_tb.tb_lineno))
+        return "error"
+
+# server metrics in the Prometheus text format, if METRICS_ENABLED
+@app.flaskapp.route("/metrics")
+def get_metrics():
+    if not app.metrics.enabled:
+        flask.abort(404)
+    return flask.Response(app.metrics.render(), mimetype="text/plain; version=0.0.4")
+
+# readiness for load balancers & process managers - 503 until the worker's first schedule load has finished
+@app.flaskapp.route("/healthz")
+def healthz():
+    schedindex = app.schedindex
+    streamstatus = app.streamstatus
+    health = {
+        'ready'                 : app.ready,
+        'scheduler'             : app.tasksched.running,
+        'schedule_generation'   : schedindex.generation if schedindex is not None else None,
+        'stream_status_age'     : round(time.time() - streamstatus.check_time, 1) if streamstatus.check_time else None
+    }
+    return flask.jsonify(health), 200 if app.ready else 503
+
 @app.flaskapp.route("/logout")
 @flask_login.login_required
 def logout():
@@ -181,50 +252,197 @@ def logout():
 @app.flaskapp.before_request
 def before_request():
     flask.g.user = flask_login.current_user
+    app.sync_shared_state()
+
+# request timing is only hooked in with metrics or request logging turned on
+if app.metrics.enabled or app.flaskapp.config['LOG_REQUESTS']:
+    @app.flaskapp.before_request
+    def start_request_timer():
+        flask.g.requeststart = time.perf_counter()
+
+if app.metrics.enabled:
+    @app.flaskapp.after_request
+    def record_request_time(response):
+        route = flask.request.url_rule.rule if flask.request.url_rule is not None else "unmatched"
+        app.requestseconds.observe(time.perf_counter() - flask.g.get("requeststart", time.perf_counter()), route, flask.request.method, response.status_code)
+        return response
+
+# a structured record for a sample of requests, with its outcome as set in flask.g.outcome by the view, or going by its status
+if app.flaskapp.config['LOG_REQUESTS']:
+    @app.flaskapp.after_request
+    def log_request(response):
+        if random.random() < app.flaskapp.config['LOG_REQUEST_SAMPLE_RATE']:
+            route = flask.request.url_rule.rule if flask.request.url_rule is not None else "unmatched"
+            seconds = time.perf_counter() - flask.g.get("requeststart", time.perf_counter())
+            outcome = flask.g.get("outcome") or ("error" if response.status_code >= 500 else "rejected" if response.status_code >= 400 else "ok")
+            logging.info("%s %s %d in %.1f ms: %s" % (flask.request.method, route, response.status_code, seconds * 1000, outcome),
+                extra={'route': route, 'method': flask.request.method, 'status': response.status_code, 'seconds': round(seconds, 6), 'outcome': outcome})
+        return response
 
 # helper functions
 
-# checks if comments are enabled for current show
-def check_comments_enabled():
-    currentday = (datetime.datetime.now().weekday() + 1) % 7
-    currenthour = str(datetime.datetime.now().hour)
-    # returns true if show's currently running AND either the current timeslot has comments enabled or the current show has comments enabled for their timeslot
-    return (app.check_show_running() and ((currenthour in app.schedobj[currentday] and app.schedobj[currentday][currenthour]['comments']) or app.get_show_comment_setting(app.get_current_showname())))
+# memoized check_comments_enabled results, as {mount: ((day, hour, stream status generation, schedule generation,
+# room settings generation), enabled)}
+# each replaced in a single assignment whenever one of its inputs changes, so the hot path reads it without locking
+# (admin comment setting changes publish a new schedule or new room settings, so they're covered by their generations)
+enableddecisions = {}
+# cache hits & misses, counted under enableddecisionslock since every request thread updates them
+enableddecisionstats = {'hits': 0, 'misses': 0}
+enableddecisionslock = Lock()
+
+# checks if comments are enabled for current show on the main mountpoint, or the given one
+# on the main mountpoint, the current timeslot's comment setting counts too, while other mountpoints only go by their show's
+def check_comments_enabled(mount=None):
+    now = datetime.datetime.now()
+    currentday = (now.weekday() + 1) % 7
+    # take one snapshot of each input, so the decision is computed from the same state as its key
+    streamstatus = app.get_mount_status(mount)
+    schedindex = app.schedindex
+    roomsettings = app.roomsettings
+    # no comment room on this mountpoint
+    if streamstatus is None:
+        return False
+    key = (currentday, now.hour, streamstatus.generation, schedindex.generation, roomsettings[0])
 
-# compares provided credentials to data in accounts file, and logs in users using flask if credentials are valid 
+    decision = enableddecisions.get(mount)
+    if decision is not None and decision[0] == key:
+        with enableddecisionslock:
+            enableddecisionstats['hits'] += 1
+        return decision[1]
+
+    showsetting = schedindex.settings.get(streamstatus.show_name, app.flaskapp.config['DEFAULT_COMMENT_SETTING'])
+    if mount is None:
+        currentslot = schedindex.get_slot(currentday, now.hour)
+        # true if show's currently running AND either the current timeslot has comments enabled or the current show has comments enabled for their timeslot
+        enabled = bool(streamstatus.show_running and ((currentslot is not None and currentslot['comments']) or showsetting))
+    else:
+        roomsetting = roomsettings[1].get(app.get_room_name(streamstatus.show_name, mount), showsetting)
+        enabled = bool(streamstatus.show_running and roomsetting)
+    enableddecisions[mount] = (key, enabled)
+    with enableddecisionslock:
+        enableddecisionstats['misses'] += 1
+        hits, misses = enableddecisionstats['hits'], enableddecisionstats['misses']
+    # every worker misses at least hourly, so this is only worth seeing when debugging
+    logging.debug("comments %s for current show on %s (enabled check cache: %d hits, %d misses)" % ("enabled" if enabled else "disabled",
+        mount or app.flaskapp.config['MAIN_MOUNTPOINT'], hits, misses))
+    return enabled
+
+# mountpoint of the comment room a request is for, from its ?mount= argument (or mount form field), None for the main mountpoint
+def get_request_mount():
+    mount = flask.request.values.get("mount")
+    if not mount or mount == app.flaskapp.config['MAIN_MOUNTPOINT']:
+        return None
+    return mount
+
+# compares provided credentials to the accounts in the account file, and logs in users using flask if credentials are valid
+# clients with too many recent failed logins, by address or by username, are turned away before their credentials are checked,
+# and only logged once, when they're first locked out
 def check_login(username, password, rememberme=False):
     try:
-        if os.path.exists(app.flaskapp.config['ACCOUNTFILE']):
-            accounts = json.load(open(app.flaskapp.config['ACCOUNTFILE']))
-            if len(accounts.keys()):
-                if username in accounts and accounts[username] == password:
-                    logging.info("logged in user %s" % username)
-                    user = User(username)
-                    flask_login.login_user(user, remember = rememberme)
-                    return flask.redirect(flask.url_for("admin"))
-                else:
-                    logging.info("failed to log in user %s" % username)
-                    flask.flash("Login failed.")
-                    return flask.redirect(flask.url_for("login"))
-            else:
-                logging.info("failed to log in user %s: account file is empty" % username)
-                flask.flash("Login failed.")
-                return flask.redirect(flask.url_for("login"))
-        else:
-            logging.info("failed to log in user %s: account file not found" % username);
+        clientaddr = flask.request.remote_addr
+        if not app.take_login_attempt(clientaddr, username):
+            flask.g.outcome = "throttled"
+            flask.flash("Too many failed logins, try again later.")
+            return flask.redirect(flask.url_for("login"))
+        logging.info("user %s attempting to log in" % username, extra={'event': "login_attempt"})
+
+        accounts = app.accountstore.get_accounts()
+        if accounts is None:
+            logging.info("failed to log in user %s: account file not found" % username)
+            app.refund_login_attempt(clientaddr, username)
             flask.flash("Login error.")
             return flask.redirect(flask.url_for("login"))
+        if not len(accounts.keys()):
+            logging.info("failed to log in user %s: account file is empty" % username)
+            app.refund_login_attempt(clientaddr, username)
+            flask.flash("Login failed.")
+            return flask.redirect(flask.url_for("login"))
+
+        if app.accountstore.check(username, password):
+            logging.info("logged in user %s" % username)
+            flask.g.outcome = "logged_in"
+            app.refund_login_attempt(clientaddr, username)
+            user = User(username)
+            flask_login.login_user(user, remember = rememberme)
+            return flask.redirect(flask.url_for("admin"))
+
+        logging.info("failed to log in user %s" % username, extra={'event': "login_failure"})
+        # the attempt taken up front stays taken
+        flask.g.outcome = "failed"
+        if not app.check_login_rate(clientaddr, username):
+            logging.warning("locked out logins from %s for user %s after repeated failures" % (clientaddr, username))
+        flask.flash("Login failed.")
+        return flask.redirect(flask.url_for("login"))
     except Exception as err:
         _, _, exc_tb = sys.exc_info()
         logging.error("Error logging into admin console: %s: %s at line %d" % (err.__class__.__name__, str(err), exc_tb.tb_lineno))
         flask.flash("Login error.")
         return flask.redirect(flask.url_for("login"))
 
-# deletes comment with the given id
-def delete_comment(commentobj, commentid):
-    commentfile = app.get_comment_file()
-    if commentid in commentobj:
-        commentobj.pop(commentid)
-    with app.commentfilelock:
-        with open(commentfile, mode="w") as commentfileobj:
-            json.dump(commentobj, commentfileobj)
+# deletes comments with the given ids from the current show on the given mountpoint in a single write, returns the deleted comments
+# logged as a single record however many are deleted
+def delete_comments(commentids, mount=None):
+    deleted = app.get_comment_log(mount=mount).delete_many(commentids)
+    if deleted:
+        logging.info("user %s deleted %d comments on %s: %s" % (flask.g.user.get_id(), len(deleted),
+            mount or app.flaskapp.config['MAIN_MOUNTPOINT'],
+            "; ".join("%s from user %s" % (comment['comment'], comment['name']) for comment in deleted.values())))
+    return deleted
+
+# format a single server-sent event
+def format_event(event, data, eventid=None):
+    if eventid is None:
+        return "event: %s\ndata: %s\n\n" % (event, json.dumps(data))
+    return "event: %s\nid: %s\ndata: %s\n\n" % (event, eventid, json.dumps(data))
+
+# generator for /comments/stream
+def comment_event_stream(since, mount=None):
+    # ask EventSource clients to wait a bit before reconnecting after the stream closes
+    yield "retry: %d\n\n" % (app.flaskapp.config['STREAM_RETRY_INTERVAL'] * 1000)
+
+    if not check_comments_enabled(mount):
+        yield format_event("disabled", None)
+        return
+
+    showname = app.get_current_showname(mount)
+    commentlog = app.get_comment_log(showname, mount)
+    broadcaster = app.get_broadcaster(showname, mount)
+
+    # note the broadcast position before taking the snapshot, so no comment can fall between the two
+    lastseq = broadcaster.seq
+    comments = commentlog.get_comments(since)
+    yield format_event("comments", comments, max(comments.keys(), key=int) if comments else None)
+
+    # with a shared state backend or SQLite storage, comments & status changes from other workers have to be polled for
+    heartbeatinterval = app.flaskapp.config['STREAM_HEARTBEAT_INTERVAL']
+    polling = app.statebackend.shared or app.commentdb is not None
+    waitinterval = min(heartbeatinterval, app.flaskapp.config['STATE_SYNC_INTERVAL']) if polling else heartbeatinterval
+    lastsent = time.time()
+
+    while True:
+        lastseq, events, missed = broadcaster.wait(lastseq, waitinterval)
+
+        # this subscriber fell behind the backlog, so resend the whole comment set
+        if missed:
+            yield format_event("comments", commentlog.get_comments())
+        else:
+            for _, event, data in events:
+                yield format_event(event, data, next(iter(data)) if event == "comment" else None)
+
+        if events:
+            lastsent = time.time()
+        elif time.time() - lastsent >= heartbeatinterval:
+            yield ": heartbeat\n\n"
+            lastsent = time.time()
+
+        if app.statebackend.shared:
+            app.sync_shared_state()
+        if polling:
+            commentlog.poll()
+
+        if app.get_current_showname(mount) != showname:
+            yield format_event("show", app.get_current_showname(mount))
+            return
+        if not check_comments_enabled(mount):
+            yield format_event("disabled", None)
+            return
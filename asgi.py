@@ -0,0 +1,6 @@
+import sys, os
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import app
+app.create_app()
+app.start_scheduler()
+from app.asgi import application
@@ -0,0 +1,291 @@
+# --------------------------------------------------------------------
+#   loadtest.py - offline load test of the comment server
+#   usage: python3 bench/loadtest.py run [options]
+#          python3 bench/loadtest.py compare <<BEFORE JSON>> <<AFTER JSON>>
+# --------------------------------------------------------------------
+
+# runs the server under gunicorn against scratch data in a temporary directory, with a stand-in Icecast serving
+# status-json.xsl for a show that's always on air and a fixture schedule, so nothing outside this machine is touched
+# concurrent clients then poll /comments and post to /new in the configured mix, and the latency, throughput and
+# server file I/O per request are saved as JSON, which compare lines up between two runs
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import argparse
+import datetime
+import tempfile
+import threading
+import subprocess
+import http.server
+
+import requests
+
+ROOTDIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+BENCHDIR = "%s/bench" % ROOTDIR
+SHOWNAME = "Bench Show"
+
+# stand-in for Icecast, reporting SHOWNAME on air on the main mountpoint
+class IcecastHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = json.dumps({'icestats': {'source': {
+            'listenurl'     : "http://127.0.0.1/stream",
+            'server_name'   : SHOWNAME,
+            'stream_start'  : "Mon, 01 Jan 2024 00:00:00 +0000"
+        }}}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def git_revision():
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOTDIR, capture_output=True, text=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOTDIR, capture_output=True, text=True).stdout.strip()
+        return "%s%s" % (revision, "-dirty" if dirty else "") if revision else None
+    except OSError:
+        return None
+
+# config overrides pointing the server at the scratch directory & stand-in Icecast
+def write_settings(workdir, icecastport, args):
+    settings = {
+        'SECRET_KEY'                : "bench",
+        'SOURCE_SCHEDULE_LOCATION'  : "%s/fixtures/schedule.json" % BENCHDIR,
+        'ACCOUNTFILE'               : "%s/accounts.json" % workdir,
+        'LOGFILE'                   : "%s/server.log" % workdir,
+        'DATA_DIRECTORY'            : "%s/data" % workdir,
+        'ICECAST_STATUS_URL'        : "http://127.0.0.1:%d/status-json.xsl" % icecastport,
+        'STREAM_STATUS_INTERVAL'    : 1,
+        'DEFAULT_COMMENT_SETTING'   : True,
+        'MAX_COMMENTS'              : args.max_comments,
+        'COMMENT_RATE'              : 0,
+        'DUPLICATE_WINDOW'          : 0,
+        'STATE_BACKEND'             : "sqlite" if args.workers > 1 else "local"
+    }
+    lines = ["%s = %r" % (key, value) for key, value in settings.items()]
+    # extra KEY=VALUE settings, with VALUE written as a Python literal
+    lines.extend(args.set)
+    with open("%s/settings.py" % workdir, "w") as settingsfile:
+        settingsfile.write("\n".join(lines) + "\n")
+    with open("%s/accounts.json" % workdir, "w") as accountsfile:
+        accountsfile.write("{}")
+
+def start_server(workdir, port, args):
+    env = dict(os.environ, COMMENT_SERVER_SETTINGS="%s/settings.py" % workdir)
+    with open("%s/gunicorn.log" % workdir, "w") as logfile:
+        # gunicorn 20.0 can't be run with -m, so call its entry point directly
+        server = subprocess.Popen([sys.executable, "-c", "from gunicorn.app.wsgiapp import run; run()", "--chdir", ROOTDIR, "--bind", "127.0.0.1:%d" % port,
+            "--workers", str(args.workers), "--worker-class", "gthread", "--threads", str(args.threads), "run:flaskapp"],
+            env=env, stdout=logfile, stderr=subprocess.STDOUT)
+
+    # ready once the server sees the show on air with comments enabled
+    url = "http://127.0.0.1:%d/comments" % port
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("server exited, see %s/gunicorn.log" % workdir)
+        try:
+            if requests.get(url, timeout=1).json() is not None:
+                return server
+        except (requests.RequestException, ValueError):
+            pass
+        time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("server didn't come up within 30 seconds, see %s/gunicorn.log" % workdir)
+
+# total I/O counters of the gunicorn master & its workers, from /proc/<<PID>>/io
+def read_io(serverpid):
+    pids = [serverpid]
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open("/proc/%s/stat" % entry) as statfile:
+                    # the parent pid comes right after the parenthesized command name
+                    if int(statfile.read().rsplit(")", 1)[1].split()[1]) == serverpid:
+                        pids.append(int(entry))
+            except (OSError, IndexError, ValueError):
+                pass
+    totals = {}
+    for pid in pids:
+        try:
+            with open("/proc/%d/io" % pid) as iofile:
+                for line in iofile:
+                    key, value = line.split(":")
+                    totals[key] = totals.get(key, 0) + int(value)
+        except OSError:
+            return None
+    return totals
+
+# one client's loop, appending (operation, seconds, ok) for each request to results
+def run_client(clientnum, baseurl, args, stoptime, results):
+    rand = random.Random(args.seed + clientnum)
+    session = requests.Session()
+    etag = None
+    sent = 0
+    while time.time() < stoptime:
+        if rand.random() < args.post_ratio:
+            operation = "post"
+            sent += 1
+            start = time.perf_counter()
+            try:
+                response = session.post("%s/new" % baseurl, data={'name': "client%d" % clientnum, 'comment': "bench comment %d from client %d" % (sent, clientnum)})
+                ok = response.status_code == 200 and response.text in ("comment successfully added", "comment section full")
+            except requests.RequestException:
+                ok = False
+        else:
+            operation = "poll"
+            headers = {'If-None-Match': etag} if args.conditional and etag else {}
+            start = time.perf_counter()
+            try:
+                response = session.get("%s/comments" % baseurl, headers=headers)
+                ok = response.status_code == 304 or (response.status_code == 200 and response.text != "error")
+                etag = response.headers.get("ETag", etag)
+            except requests.RequestException:
+                ok = False
+        results.append((operation, time.perf_counter() - start, ok))
+
+def percentile(sortedvalues, fraction):
+    if not sortedvalues:
+        return None
+    return sortedvalues[min(len(sortedvalues) - 1, int(fraction * len(sortedvalues)))]
+
+def summarize(latencies, errors, seconds):
+    latencies = sorted(latencies)
+    return {
+        'requests'          : len(latencies),
+        'errors'            : errors,
+        'requests_per_sec'  : len(latencies) / seconds,
+        'p50_ms'            : percentile(latencies, 0.5) * 1000 if latencies else None,
+        'p99_ms'            : percentile(latencies, 0.99) * 1000 if latencies else None,
+        'mean_ms'           : sum(latencies) / len(latencies) * 1000 if latencies else None
+    }
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix="comment-server-bench-")
+    os.makedirs("%s/data/comments" % workdir)
+    icecast = http.server.ThreadingHTTPServer(("127.0.0.1", 0), IcecastHandler)
+    threading.Thread(target=icecast.serve_forever, daemon=True).start()
+    write_settings(workdir, icecast.server_address[1], args)
+    port = free_port()
+    server = start_server(workdir, port, args)
+    try:
+        baseurl = "http://127.0.0.1:%d" % port
+        # warm up connections & caches before measuring
+        run_client(-1, baseurl, args, time.time() + args.warmup, [])
+
+        startio = read_io(server.pid)
+        results = []
+        stoptime = time.time() + args.duration
+        clients = [threading.Thread(target=run_client, args=(clientnum, baseurl, args, stoptime, results)) for clientnum in range(args.clients)]
+        start = time.perf_counter()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        seconds = time.perf_counter() - start
+        endio = read_io(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+        icecast.shutdown()
+
+    summary = {
+        'revision'  : git_revision(),
+        'timestamp' : datetime.datetime.now().isoformat(timespec="seconds"),
+        'settings'  : {key: value for key, value in vars(args).items() if key not in ("func", "output", "keep")},
+        'seconds'   : seconds,
+        'total'     : summarize([result[1] for result in results], sum(1 for result in results if not result[2]), seconds)
+    }
+    for operation in ("poll", "post"):
+        summary[operation] = summarize([result[1] for result in results if result[0] == operation],
+            sum(1 for result in results if result[0] == operation and not result[2]), seconds)
+    # rchar/wchar count all bytes passed to read/write calls, read_bytes/write_bytes only those reaching the disk
+    if startio is not None and endio is not None and results:
+        summary['io_per_request'] = {key: (endio[key] - startio[key]) / len(results) for key in endio if key in startio}
+
+    print_summary(summary)
+    output = args.output or "%s/results/%s-%s.json" % (BENCHDIR, summary['timestamp'].replace(":", ""), summary['revision'] or "unknown")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as outputfile:
+        json.dump(summary, outputfile, indent=2)
+    print("saved results to %s" % output)
+    if args.keep:
+        print("kept scratch directory %s" % workdir)
+    else:
+        shutil.rmtree(workdir)
+    return 0
+
+def format_number(value):
+    return "-" if value is None else "%.2f" % value
+
+def print_summary(summary):
+    print("revision %s, %.1f seconds" % (summary['revision'], summary['seconds']))
+    print("%-6s %10s %8s %12s %10s %10s" % ("", "requests", "errors", "requests/s", "p50 ms", "p99 ms"))
+    for operation in ("poll", "post", "total"):
+        result = summary[operation]
+        print("%-6s %10d %8d %12s %10s %10s" % (operation, result['requests'], result['errors'], format_number(result['requests_per_sec']),
+            format_number(result['p50_ms']), format_number(result['p99_ms'])))
+    if 'io_per_request' in summary:
+        io = summary['io_per_request']
+        print("per request: %s bytes written (%s to disk), %s write calls, %s bytes read" % (format_number(io.get('wchar')),
+            format_number(io.get('write_bytes')), format_number(io.get('syscw')), format_number(io.get('rchar'))))
+
+# line up the headline numbers of two saved runs
+def compare(args):
+    with open(args.before) as beforefile:
+        before = json.load(beforefile)
+    with open(args.after) as afterfile:
+        after = json.load(afterfile)
+    print("%-28s %14s %14s %9s" % ("", before['revision'], after['revision'], "change"))
+    rows = [("%s %s" % (operation, key), before[operation][key], after[operation][key])
+        for operation in ("poll", "post", "total") for key in ("requests_per_sec", "p50_ms", "p99_ms")]
+    rows.extend(("io %s" % key, before.get('io_per_request', {}).get(key), after.get('io_per_request', {}).get(key))
+        for key in ("wchar", "write_bytes", "syscw", "rchar"))
+    for name, beforevalue, aftervalue in rows:
+        change = "%+.1f%%" % ((aftervalue - beforevalue) / beforevalue * 100) if beforevalue and aftervalue is not None else "-"
+        print("%-28s %14s %14s %9s" % (name, format_number(beforevalue), format_number(aftervalue), change))
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="offline load test of the comment server")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    runparser = subparsers.add_parser("run", help="run a load test and save its results")
+    runparser.add_argument("--clients", type=int, default=16, help="concurrent clients")
+    runparser.add_argument("--duration", type=float, default=10, help="seconds to measure for")
+    runparser.add_argument("--warmup", type=float, default=1, help="seconds to warm up for before measuring")
+    runparser.add_argument("--post-ratio", type=float, default=0.1, help="fraction of requests that post a comment, the rest poll /comments")
+    runparser.add_argument("--conditional", action="store_true", help="poll with If-None-Match, like a client reusing its last ETag")
+    runparser.add_argument("--workers", type=int, default=1, help="gunicorn worker processes")
+    runparser.add_argument("--threads", type=int, default=8, help="threads per gunicorn worker")
+    runparser.add_argument("--max-comments", type=int, default=1000000, help="MAX_COMMENTS for the run")
+    runparser.add_argument("--seed", type=int, default=1, help="random seed for the request mix")
+    runparser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+        help="extra config setting, with VALUE as a Python literal, e.g. --set 'COMMENT_INGEST=\"queue\"'")
+    runparser.add_argument("--output", help="results file, defaults to bench/results/<<TIMESTAMP>>-<<REVISION>>.json")
+    runparser.add_argument("--keep", action="store_true", help="keep the scratch directory, with the server's logs & data")
+    runparser.set_defaults(func=run)
+
+    compareparser = subparsers.add_parser("compare", help="compare two saved results")
+    compareparser.add_argument("before")
+    compareparser.add_argument("after")
+    compareparser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,71 @@
+# --------------------------------------------------------------------
+#   sanitize_bench.py - compare comment sanitizing against the bleach path
+#   usage: python3 bench/sanitize_bench.py [--number N] [--write-corpus]
+# --------------------------------------------------------------------
+
+import os
+import re
+import sys
+import json
+import timeit
+import argparse
+import importlib.util
+
+import bleach
+
+ROOTDIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+CORPUSFILE = "%s/testdata/sanitize_corpus.json" % ROOTDIR
+
+# loaded straight from its file, so timing it doesn't pull in Flask & the rest of the app package
+spec = importlib.util.spec_from_file_location("sanitize", "%s/app/sanitize.py" % ROOTDIR)
+sanitize = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(sanitize)
+
+# default PARSED_LINK_FORMAT from config.py
+LINK_FORMAT = "<a href=http://\\1 target=\"_blank\">\\1</a>"
+
+# the original per-comment path from add_comment
+def bleach_path(text):
+    return re.sub("(?:(?:http(?:s)?://)|^|\\s)([^\\s/$?.#:]*\\.[^\\s\\.][^\\s]*)", LINK_FORMAT, bleach.clean(text, tags=[]))
+
+def sanitize_path(text):
+    return sanitize.parse_links(sanitize.clean(text), LINK_FORMAT)
+
+# rewrite the expected outputs in the corpus from the bleach path, keeping its inputs
+def write_corpus():
+    with open(CORPUSFILE) as corpusfile:
+        corpus = json.load(corpusfile)
+    corpus = [{'input': case['input'], 'clean': bleach.clean(case['input'], tags=[]), 'linked': bleach_path(case['input'])} for case in corpus]
+    with open(CORPUSFILE, "w") as corpusfile:
+        json.dump(corpus, corpusfile, indent=1, ensure_ascii=False)
+        corpusfile.write("\n")
+    print("wrote %d cases to %s" % (len(corpus), CORPUSFILE))
+
+def main():
+    parser = argparse.ArgumentParser(description="comment sanitizer microbenchmark")
+    parser.add_argument("--number", type=int, default=20, help="passes over the corpus per timing")
+    parser.add_argument("--write-corpus", action="store_true", help="regenerate expected outputs from the bleach path")
+    args = parser.parse_args()
+    if args.write_corpus:
+        write_corpus()
+        return 0
+
+    with open(CORPUSFILE) as corpusfile:
+        corpus = json.load(corpusfile)
+    mismatches = [case['input'] for case in corpus if sanitize_path(case['input']) != case['linked']]
+    if mismatches:
+        print("output differs from the bleach path for: %s" % ", ".join(repr(text) for text in mismatches))
+        return 1
+
+    texts = [case['input'] for case in corpus]
+    fastpath = sum(1 for text in texts if sanitize.FALLBACK_PATTERN.search(text) is None)
+    results = {}
+    for name, func in (("bleach", bleach_path), ("sanitize", sanitize_path)):
+        seconds = min(timeit.repeat(lambda: [func(text) for text in texts], number=args.number, repeat=5))
+        results[name] = seconds / (args.number * len(texts)) * 1e6
+        print("%-10s %8.2f us/comment" % (name, results[name]))
+    print("%d of %d corpus comments took the fast path, %.1fx speedup" % (fastpath, len(texts), results['bleach'] / results['sanitize']))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
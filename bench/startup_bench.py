@@ -0,0 +1,172 @@
+# --------------------------------------------------------------------
+#   startup_bench.py - time how long the comment server takes to start
+#   usage: python3 bench/startup_bench.py [options]
+# --------------------------------------------------------------------
+
+# each run starts from a fresh interpreter against scratch data in a temporary directory, with the stand-in Icecast
+# from loadtest.py and the fixture schedule served over HTTP after a configurable delay, standing in for a slow source
+# measures, as medians over the runs:
+#   import      - importing the app package
+#   create_app  - create_app(), opening storage & loading the saved schedule
+#   serving     - launching a gunicorn worker until it answers /comments
+#   ready       - launching a gunicorn worker until /healthz reports its first schedule load done
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import datetime
+import statistics
+import tempfile
+import threading
+import subprocess
+import http.server
+
+import requests
+
+from loadtest import ROOTDIR, BENCHDIR, IcecastHandler, free_port, git_revision
+
+# imports the app & sets it up, printing the time each step took as JSON
+# revisions from before create_app did all their setup on import, so they're timed as a whole by the import step
+# os._exit skips the exit handlers, which would only add shutdown time to the run
+PROBE = """
+import sys, time, json, os
+sys.path.insert(0, %r)
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+if hasattr(app, "create_app"):
+    app.create_app()
+created = time.perf_counter()
+print(json.dumps({'import': imported - start, 'create_app': created - imported}))
+sys.stdout.flush()
+os._exit(0)
+"""
+
+# serves the fixture schedule, taking args.schedule_delay seconds to answer
+def schedule_handler(delay):
+    class ScheduleHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(delay)
+            with open("%s/fixtures/schedule.json" % BENCHDIR, mode="rb") as schedulefile:
+                body = schedulefile.read()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+    return ScheduleHandler
+
+def write_settings(workdir, icecastport, scheduleport):
+    settings = {
+        'SECRET_KEY'                : "bench",
+        'SOURCE_SCHEDULE_LOCATION'  : "http://127.0.0.1:%d/schedule.json" % scheduleport,
+        'ACCOUNTFILE'               : "%s/accounts.json" % workdir,
+        'LOGFILE'                   : "%s/server.log" % workdir,
+        'DATA_DIRECTORY'            : "%s/data" % workdir,
+        'ICECAST_STATUS_URL'        : "http://127.0.0.1:%d/status-json.xsl" % icecastport,
+        'DEFAULT_COMMENT_SETTING'   : True
+    }
+    with open("%s/settings.py" % workdir, "w") as settingsfile:
+        settingsfile.write("\n".join("%s = %r" % (key, value) for key, value in settings.items()) + "\n")
+    with open("%s/accounts.json" % workdir, "w") as accountsfile:
+        accountsfile.write("{}")
+
+def time_import(env):
+    output = subprocess.run([sys.executable, "-c", PROBE % ROOTDIR], env=env, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+# seconds from launching gunicorn until it first answers /comments, and until /healthz answers 200
+# revisions without /healthz loaded the schedule before serving anything, so they're ready once serving
+def time_worker(workdir, env, args):
+    port = free_port()
+    baseurl = "http://127.0.0.1:%d" % port
+    start = time.perf_counter()
+    with open("%s/gunicorn.log" % workdir, "a") as logfile:
+        # gunicorn 20.0 can't be run with -m, so call its entry point directly
+        server = subprocess.Popen([sys.executable, "-c", "from gunicorn.app.wsgiapp import run; run()", "--chdir", ROOTDIR,
+            "--bind", "127.0.0.1:%d" % port, "--workers", "1", "run:flaskapp"], env=env, stdout=logfile, stderr=subprocess.STDOUT)
+    serving = ready = None
+    try:
+        deadline = time.time() + args.timeout
+        while ready is None and time.time() < deadline:
+            if server.poll() is not None:
+                raise RuntimeError("server exited, see %s/gunicorn.log" % workdir)
+            try:
+                if serving is None:
+                    requests.get("%s/comments" % baseurl, timeout=1)
+                    serving = time.perf_counter() - start
+                status = requests.get("%s/healthz" % baseurl, timeout=1).status_code
+                if status == 200:
+                    ready = time.perf_counter() - start
+                elif status == 404:
+                    ready = serving
+            except requests.RequestException:
+                pass
+            time.sleep(0.01)
+    finally:
+        server.terminate()
+        server.wait()
+    if ready is None:
+        raise RuntimeError("server wasn't ready within %d seconds, see %s/gunicorn.log" % (args.timeout, workdir))
+    return serving, ready
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix="comment-server-startup-")
+    icecast = http.server.ThreadingHTTPServer(("127.0.0.1", 0), IcecastHandler)
+    schedule = http.server.ThreadingHTTPServer(("127.0.0.1", 0), schedule_handler(args.schedule_delay))
+    for server in (icecast, schedule):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    write_settings(workdir, icecast.server_address[1], schedule.server_address[1])
+    env = dict(os.environ, COMMENT_SERVER_SETTINGS="%s/settings.py" % workdir)
+
+    timings = {'import': [], 'create_app': [], 'serving': [], 'ready': []}
+    try:
+        for _ in range(args.runs):
+            # start each run without a saved schedule, like a fresh deploy
+            shutil.rmtree("%s/data" % workdir, ignore_errors=True)
+            os.makedirs("%s/data/comments" % workdir)
+            for key, seconds in time_import(env).items():
+                timings[key].append(seconds)
+            serving, ready = time_worker(workdir, env, args)
+            timings['serving'].append(serving)
+            timings['ready'].append(ready)
+    finally:
+        icecast.shutdown()
+        schedule.shutdown()
+
+    summary = {
+        'revision'  : git_revision(),
+        'timestamp' : datetime.datetime.now().isoformat(timespec="seconds"),
+        'settings'  : {'runs': args.runs, 'schedule_delay': args.schedule_delay},
+        'median_ms' : {key: statistics.median(values) * 1000 for key, values in timings.items()}
+    }
+    print("revision %s, %d runs, schedule source answering after %.1f seconds" % (summary['revision'], args.runs, args.schedule_delay))
+    for key, value in summary['median_ms'].items():
+        print("%-12s %10.1f ms" % (key, value))
+    if args.output:
+        with open(args.output, "w") as outputfile:
+            json.dump(summary, outputfile, indent=2)
+        print("saved results to %s" % args.output)
+    if args.keep:
+        print("kept scratch directory %s" % workdir)
+    else:
+        shutil.rmtree(workdir)
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="time how long the comment server takes to start")
+    parser.add_argument("--runs", type=int, default=5, help="runs to take the median of")
+    parser.add_argument("--schedule-delay", type=float, default=2, help="seconds the schedule source takes to answer")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for a worker to become ready")
+    parser.add_argument("--output", help="file to save the results to as JSON")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory, with the server's logs & data")
+    return run(parser.parse_args())
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -42,13 +42,16 @@ SECRET_KEY = "<<ENTER SECRET KEY HERE>>"
 # ]
 # Note that the comment server will periodically poll the source schedule and update its internal representation accordingly,
 # so you do not need to restart the comment server after making changes to the source schedule
-# also, the comment server saves its internal schedule representation to <COMMENT SERVER BASE DIRECTORY>/json/schedule.json, so
+# also, the comment server saves its internal schedule representation to schedule.json in DATA_DIRECTORY, so
 # DO NOT use that location for the source schedule
 # recommended location: <<COMMENT SERVER BASE DIRECTORY>>/json/source_schedule.json
 # you can also provide a web location: just provide a url starting with http:// or https://
 
 SOURCE_SCHEDULE_LOCATION = "<<PATH TO SOURCE_SCHEDULE_FILE_HERE>>"
 
+# seconds to wait for a web source schedule to respond - a refresh that times out keeps the current schedule
+SCHEDULE_SOURCE_TIMEOUT = 10
+
 # CRON argument dictionaries for the two periodic tasks of the server: refreshing the schedule from the provided source, 
 # and clearing out old comment files. Refer to the specification here for information on what arguments to provide:
 # https://apscheduler.readthedocs.io/en/v2.1.2/cronschedule.html
@@ -59,18 +62,28 @@ SOURCE_SCHEDULE_LOCATION = "<<PATH TO SOURCE_SCHEDULE_FILE_HERE>>"
 
 # default - every fifteen minutes
 REFRESH_SCHEDULE_CRON = {
-    minute: "*/15"
+    "minute": "*/15"
 }
 
 # default - every day at 2 AM
 CLEAR_COMMENTS_CRON = {
-    minute: "0"
-    hour: "2"
+    "minute": "0",
+    "hour": "2"
+}
+
+# comments are stored in append-only log files, which are periodically fsynced and compacted
+# (rewritten without deleted comments) in the background
+
+# default - every ten minutes
+COMPACT_COMMENTS_CRON = {
+    "minute": "*/10"
 }
 
 # provide accounts for DJs to log into the comment server admin page
 # store accounts in a JSON dictionary, where the key is the username and the value is the password
 # EX: {"account1" : "password1", "account2" : "password2"}
+# then run "python3 manage.py hash-passwords" to replace the passwords with salted hashes
+# the file is read again whenever it changes, so accounts can be added without restarting the server
 # This server ships without any default credentials, so login will not be possible until you populate this file!
 # recommended location: <<COMMENT SERVER BASE DIRECTORY>>/json/accounts.json
 ACCOUNTFILE = "<<PATH TO ACCOUNT FILE HERE>>"
@@ -78,13 +91,40 @@ ACCOUNTFILE = "<<PATH TO ACCOUNT FILE HERE>>"
 # path to write all log output to (not just errors)
 LOGFILE = "<<PATH TO LOG FILE HERE>>"
 
+# directory holding the internal schedule, comment logs & default database locations
+# leave empty to use <<COMMENT SERVER BASE DIRECTORY>>/json
+DATA_DIRECTORY = ""
+
+# how hard to make sure rewritten files (the internal schedule & compacted comment logs) reach the disk
+# each rewrite goes to a temporary file renamed into place, so no reader ever sees a partial file whichever you pick
+# "full" - fsync the file & its directory (safest), "file" - fsync the file only, "none" - leave it to the operating system (fastest)
+WRITE_DURABILITY = "full"
+
 # URL of Icecast status-json.xsl file containing current status info
 ICECAST_STATUS_URL = "http://localhost:8000/status-json.xsl"
 
+# seconds between background checks of the Icecast status
+STREAM_STATUS_INTERVAL = 5
+
+# seconds to wait for Icecast to respond to a status check
+ICECAST_TIMEOUT = 3
+
+# if Icecast can't be reached, the last known status is kept for this many seconds,
+# after which the show is treated as not running
+ICECAST_MAX_STALENESS = 30
+
 # name of Icecast mountpoint on which shows are broadcst
 # essentially, the mountpoint for which you want comments
 MAIN_MOUNTPOINT = "stream"
 
+# other Icecast mountpoints with comment rooms of their own, e.g. ["talk", "stream-hq"]
+# clients pick a room with ?mount=<<MOUNTPOINT>> on /comments, /comments/stream & /new (leaving it out means MAIN_MOUNTPOINT)
+# each room keeps its own comments, and has comments enabled while a show runs on its mountpoint with comments enabled -
+# the schedule's timeslot settings only apply to MAIN_MOUNTPOINT
+# the admin console lists each mountpoint's current show as its own room, whose setting is saved to room_settings.json
+# in DATA_DIRECTORY - a room that was never set goes by its show's setting, or DEFAULT_COMMENT_SETTING if it's not on the schedule
+COMMENT_MOUNTPOINTS = []
+
 # --------------------------------
 #   Comment Content Settings
 # --------------------------------
@@ -95,6 +135,9 @@ DEFAULT_COMMENT_SETTING = False
 # max number of comments per show
 MAX_COMMENTS = 2000
 
+# number of comments shown per page in the admin console's comment editor
+ADMIN_COMMENTS_PAGE_SIZE = 50
+
 # max length of "name" item in comment
 MAX_NAME_LENGTH = 20
 
@@ -108,3 +151,202 @@ PARSE_LINKS = True
 # use \1 to insert the matched link
 # the default is the simplest form, which just encases each link in an <a> tag which opens in a new tab
 PARSED_LINK_FORMAT = "<a href=http://\\1 target=\"_blank\">\\1</a>"
+
+# --------------------------------
+#   Flood Protection Settings
+# --------------------------------
+
+# comments each client may post per second, on average, e.g. 0.2 - 0 turns off rate limiting
+# clients are limited by IP address, and every worker process keeps its own limits
+# behind a reverse proxy every client comes from the proxy's address, and shares one limit, so set PROXY_COUNT first
+COMMENT_RATE = 0
+
+# also limit clients by the name they post under, so switching addresses doesn't get around COMMENT_RATE
+# anyone can post under any name though, so this lets one client use up another's limit by posting as them
+COMMENT_RATE_BY_NAME = False
+
+# number of comments a client may post in a quick burst before COMMENT_RATE kicks in, e.g. 5
+COMMENT_BURST = 5
+
+# number of reverse proxies (Apache, nginx...) in front of the app - each adds the address it got the request from to
+# the X-Forwarded-For header, and with this set, a client's IP address is taken from there, for rate limiting & logging
+# leave this at 0 when clients connect directly, or they could pick their own address by sending the header
+PROXY_COUNT = 0
+
+# max number of clients whose limits are remembered at once - the least recently seen are forgotten first
+RATE_LIMIT_TABLE_SIZE = 10000
+
+# failed admin logins allowed per second, on average, from each IP address and for each username - 0 turns off login throttling
+# once a client runs out, its logins are turned away without checking its credentials until it's allowed another
+LOGIN_FAILURE_RATE = 1 / 60
+
+# number of failed logins allowed in a quick burst before LOGIN_FAILURE_RATE kicks in - this also caps the logins
+# being checked at once, since each attempt counts as a failure until it succeeds
+LOGIN_FAILURE_BURST = 5
+
+# number of recent comments per show checked for duplicates - a comment repeating one of these under the same name,
+# ignoring case & whitespace, is turned away, e.g. 50 - 0 turns off duplicate checking
+DUPLICATE_WINDOW = 0
+
+# --------------------------------
+#   Comment Storage Settings
+# --------------------------------
+
+# where comments are stored
+# "log" - an append-only log file per show in the comments directory of DATA_DIRECTORY
+# "sqlite" - a single SQLite database; run "python3 manage.py import-comments" after switching to bring over existing comments
+COMMENT_STORAGE = "log"
+
+# path of the SQLite database for "sqlite" comment storage
+# leave empty to use comments.db in DATA_DIRECTORY
+COMMENT_DATABASE = ""
+
+# with "sqlite" comment storage, comments are grouped into episodes by date, and each show only sees the current episode's
+# comments. Episodes start at this hour each day, which should match CLEAR_COMMENTS_CRON, so that shows running past
+# midnight stay in one episode. CLEAR_COMMENTS_CRON then archives & deletes comments from previous episodes.
+EPISODE_START_HOUR = 2
+
+# when to fsync a show's comment log after appending a comment or deletion to it
+# "always" - after every write (safest), "interval" - at most once every COMMENT_LOG_FSYNC_INTERVAL seconds,
+# "never" - leave flushing to the operating system (fastest)
+COMMENT_LOG_FSYNC = "always"
+
+# seconds between fsyncs when COMMENT_LOG_FSYNC is "interval"
+COMMENT_LOG_FSYNC_INTERVAL = 1.0
+
+# number of deleted-comment records a log must build up before it's compacted
+COMMENT_LOG_COMPACT_THRESHOLD = 200
+
+# how submitted comments are written: "direct" - each request writes its own comment,
+# "queue" - requests hand comments to a single writer thread, which commits them in batches with one write
+# (and one fsync) per show, and each request waits until its batch is committed
+COMMENT_INGEST = "direct"
+
+# with "queue" ingest, max number of comments committed in one batch
+INGEST_BATCH_SIZE = 100
+
+# with "queue" ingest, max number of seconds a batch waits for more comments after the first one arrives
+INGEST_BATCH_WAIT = 0.005
+
+# with "queue" ingest, max number of seconds a request waits for its comment to be committed before giving up with an error
+INGEST_TIMEOUT = 10
+
+# with "queue" ingest, number of seconds between logging queue depth & batch sizes - 0 turns it off
+INGEST_METRICS_INTERVAL = 300
+
+# --------------------------------
+#   Comment Archive Settings
+# --------------------------------
+
+# whether to keep an archive of comments - each show's comments are archived in the background when it ends,
+# and again before CLEAR_COMMENTS_CRON clears them, as gzipped JSON lines per show per episode
+# read them back with "python3 manage.py show-archive <<EPISODE DATE>> <<SHOW NAME>>"
+ARCHIVE_COMMENTS = True
+
+# directory holding archived comments
+# leave empty to use archive in DATA_DIRECTORY
+ARCHIVE_DIRECTORY = ""
+
+# days comments stay live before CLEAR_COMMENTS_CRON archives & removes them - counted from the end of the episode they
+# were posted in, so a show's earlier airings are removed even while it keeps getting comments - 0 clears everything
+# on each run (with "sqlite" comment storage, everything from past episodes)
+COMMENT_RETENTION_DAYS = 0
+
+# days archived comments are kept for, counted by episode - 0 keeps them forever
+ARCHIVE_RETENTION_DAYS = 0
+
+# --------------------------------
+#   Comment Stream Settings
+# --------------------------------
+
+# seconds between heartbeats sent to idle /comments/stream subscribers
+STREAM_HEARTBEAT_INTERVAL = 15
+
+# seconds EventSource clients should wait before reconnecting after a stream closes
+STREAM_RETRY_INTERVAL = 10
+
+# number of recent events kept per show for subscribers that fall behind
+STREAM_BACKLOG = 200
+
+# --------------------------------
+#   Response Settings
+# --------------------------------
+
+# /comments bodies of at least this many bytes are sent compressed to clients that accept it,
+# with brotli if the brotli package is installed, otherwise gzip - each version is compressed once and reused
+COMPRESS_MIN_SIZE = 1024
+
+# Cache-Control header sent with /comments - the default has caches revalidate every poll against the ETag
+COMMENTS_CACHE_CONTROL = "no-cache"
+
+# --------------------------------
+#   Static Snapshot Settings
+# --------------------------------
+
+# directory to keep static copies of GET /comments in, for the web server to serve directly - leave empty to turn snapshots off
+# after comments are added, deleted or cleared, or comments are enabled or disabled, comments.json is rewritten with the
+# current show's comments ("null" while comments are disabled), along with a gzipped copy, comments.json.gz
+# rooms on other COMMENT_MOUNTPOINTS get comments-<<MOUNTPOINT>>.json
+# EX: <<WEB ROOT>>/comments, served as https://<<YOUR SITE>>/comments/comments.json
+SNAPSHOT_DIRECTORY = ""
+
+# max number of seconds a change waits to be written to the snapshots - changes within this long of each other
+# are written together, so snapshots are rewritten at most once this often, however busy the comments get
+SNAPSHOT_INTERVAL = 1.0
+
+# how hard snapshot writes work to reach the disk, as for WRITE_DURABILITY - the snapshots are always rewritten
+# from the comments after a crash, so by default they're left for the operating system to flush
+SNAPSHOT_DURABILITY = "none"
+
+# --------------------------------
+#   Metrics Settings
+# --------------------------------
+
+# whether to collect request, Icecast, schedule & comment storage timings and serve them on /metrics for Prometheus
+# with this off, /metrics returns 404 and the timing hooks aren't installed
+METRICS_ENABLED = False
+
+# --------------------------------
+#   Logging Settings
+# --------------------------------
+
+# format of the lines written to LOGFILE
+# "text" - timestamp, level & message
+# "json" - one JSON object per line, also carrying any structured fields such as route, status, seconds & outcome
+LOG_FORMAT = "text"
+
+# max number of log records waiting to be written - records are written to LOGFILE by a background thread,
+# so a slow disk never holds up a request, and records arriving while this many are waiting are dropped & counted
+# 0 writes every record straight to LOGFILE as it's logged
+LOG_QUEUE_SIZE = 10000
+
+# max number of messages logged for each kind of high-frequency event (invalid comments, login attempts, failed logins,
+# admin page views) in every LOG_EVENT_INTERVAL seconds - the rest are counted, and the count logged with the next one let through
+# 0 logs them all
+LOG_EVENT_LIMIT = 20
+LOG_EVENT_INTERVAL = 60
+
+# whether to log a record for each request, with its route, method, status, seconds taken & outcome
+# read when the app package is imported, like METRICS_ENABLED
+LOG_REQUESTS = False
+
+# fraction of requests logged with LOG_REQUESTS on, picked at random - lower it on busy servers
+LOG_REQUEST_SAMPLE_RATE = 1.0
+
+# --------------------------------
+#   Shared State Settings
+# --------------------------------
+
+# how comments, schedule comment settings & Icecast status are kept when running multiple worker processes
+# (e.g. gunicorn -w 4)
+# "local" - each process keeps its own state; only use this with a single worker process
+# "sqlite" - state is shared between workers through a SQLite database & lock files, and scheduled tasks
+# only run in one elected worker
+STATE_BACKEND = "local"
+
+# path of the SQLite database for the "sqlite" state backend; lock files are kept in a directory next to it
+# leave empty to use state.db in DATA_DIRECTORY
+STATE_DATABASE = ""
+
+# seconds between each worker's checks for schedule & Icecast status changes made by other workers
+STATE_SYNC_INTERVAL = 1.0
@@ -0,0 +1,57 @@
+# --------------------------------------------------------------------
+#   manage.py - command line maintenance tasks for comment server
+#   usage: python3 manage.py <command>
+# --------------------------------------------------------------------
+
+import sys, os
+import argparse
+import json
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import app
+
+# import existing comment files into the SQLite comment database
+def import_comments(args):
+    if app.commentdb is None:
+        print("set COMMENT_STORAGE to \"sqlite\" in config.py before importing comments")
+        return 1
+    print("imported %d comments into %s" % (app.import_comment_files(), app.commentdb.path))
+    return 0
+
+# print a show's archived comments from an episode, one {id: {name, comment}} object per line
+# without a show, lists the shows archived in the episode
+def show_archive(args):
+    if args.episode not in app.list_episodes(app.ARCHIVEDIR):
+        print("no comments archived for episode %s, archived episodes: %s" % (args.episode, ", ".join(app.list_episodes(app.ARCHIVEDIR)) or "none"))
+        return 1
+    if args.show is None:
+        for filename in sorted(os.listdir("%s/%s" % (app.ARCHIVEDIR, args.episode))):
+            print(filename[:-len(".jsonl.gz")])
+        return 0
+    if not os.path.exists(app.get_archive_file(args.show, args.episode)):
+        print("no comments archived for %s in episode %s" % (args.show, args.episode))
+        return 1
+    for commentid, comment in app.read_archived_comments(args.show, args.episode):
+        print(json.dumps({commentid: comment}))
+    return 0
+
+# replace the plaintext passwords in the account file with salted hashes
+def hash_passwords(args):
+    if not os.path.exists(app.flaskapp.config['ACCOUNTFILE']):
+        print("account file %s not found, set ACCOUNTFILE in config.py" % app.flaskapp.config['ACCOUNTFILE'])
+        return 1
+    print("hashed %d passwords in %s" % (app.hash_passwords(app.flaskapp.config['ACCOUNTFILE'], app.flaskapp.config['WRITE_DURABILITY']),
+        app.flaskapp.config['ACCOUNTFILE']))
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="comment server maintenance tasks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("import-comments", help="import comment files from json/comments into the SQLite comment database").set_defaults(func=import_comments)
+    archiveparser = subparsers.add_parser("show-archive", help="print a show's archived comments from an episode, or list the shows archived in it")
+    archiveparser.add_argument("episode", help="episode date, as YYYY-MM-DD")
+    archiveparser.add_argument("show", nargs="?", help="show name")
+    archiveparser.set_defaults(func=show_archive)
+    subparsers.add_parser("hash-passwords", help="replace plaintext passwords in the account file with salted hashes").set_defaults(func=hash_passwords)
+    args = parser.parse_args()
+    app.create_app()
+    sys.exit(args.func(args))
@@ -1,3 +1,5 @@
 import sys, os
 sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
-from app import flaskapp
+import app
+flaskapp = app.create_app()
+app.start_scheduler()